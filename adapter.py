@@ -1,5 +1,12 @@
 import argparse
+import collections
+import functools
+import hashlib
+import io
+import multiprocessing
 import os
+import queue
+import time
 from pathlib import Path
 
 import math
@@ -8,15 +15,19 @@ import numpy as np
 import cv2
 import matplotlib.pyplot as plt
 from parso import split_lines
-import tensorflow as tf
 import progressbar
 
-from waymo_open_dataset.utils import range_image_utils
-from waymo_open_dataset.utils import transform_utils
-from waymo_open_dataset.utils import test_utils
-from waymo_open_dataset.utils import box_utils
 from waymo_open_dataset import dataset_pb2 as open_dataset
 from adapter_lib import *
+from frame_lib import Inflater, read_matrix, select_frame
+from lidar_lib import LIDAR_RETURNS, CalibrationCache, PointCloudBuffer, \
+    compare_point_clouds, count_points_in_box, range_images_to_point_cloud
+from parallel_lib import AutoScaler, SharedArrayRing, Stage, run_pipeline
+from parallel_lib import advance_frame_num, count_keyframes, plan_segments
+from parallel_lib import prefetch, schedule_jobs, shard_jobs, thread_layout
+from segment_lib import Manifest, MetadataCache, read_frame_list, read_json, segment_index
+from segment_lib import write_json
+from tfrecord_lib import iter_records, read_record
 
 import pdb
 ############################Config###########################################
@@ -41,12 +52,51 @@ IMAGE_PATH = KITTI_PATH + '/image_0'
 CALIB_PATH = KITTI_PATH + '/calib'
 LIDAR_PATH = KITTI_PATH + '/velodyne'
 IMG_CALIB_PATH = KITTI_PATH + '/img_calib'
+WATCH_STATE_PATH = KITTI_PATH + '/watch_state.json'
+MANIFEST_PATH = KITTI_PATH + '/manifest.json'
+INDEX_PATH = KITTI_PATH + '/index'
+METADATA_PATH = KITTI_PATH + '/segment_metadata.json'
+# disk usage of a frame assumed by --dry_run while no frame is converted
+FRAME_BYTES_ESTIMATE = 7 << 20
+# largest arrays of a frame handed over shared memory by --pipeline, they
+# size the slots of its rings: the pixels of the range images of one return
+# of all the lasers, the range images, the top laser pixel poses and the
+# camera image
+RANGE_IMAGE_PIXELS = 64 * 2650 + 4 * 200 * 600
+RANGE_IMAGES_BYTES = RANGE_IMAGE_PIXELS * 4 * 4
+TOP_POSE_BYTES = 64 * 2650 * 6 * 4
+IMAGE_BYTES = 1920 * 1280 * 3
+# smallest slot of the record ring
+RECORD_SLOT_BYTES = 8 << 20
 ###############################################################################
 
+# TensorFlow and the waymo utils take seconds and a lot of memory to import,
+# they are only loaded by load_tensorflow when a frame needs them
+tf = None
+range_image_utils = None
+transform_utils = None
+test_utils = None
+box_utils = None
+# threads given to TensorFlow when it is loaded, see set_thread_budget
+thread_budget = None
+
 
 class Adapter:
 
-    def __init__(self):
+    def __init__(self, lidar_engine='tf', validate_lidar=False, lidar_returns='first',
+                 calibration_segments=4):
+        """
+                :param lidar_engine: 'tf' to compute the point clouds and the
+                    points in boxes with TensorFlow, 'tf_graph' the same with
+                    the point clouds in a compiled graph, see lidar_tf_lib,
+                    'numpy' with lidar_lib
+                :param validate_lidar: also compute every point cloud with the
+                    other engine and check that they match
+                :param lidar_returns: range image returns in the point clouds,
+                    'first', 'second' or 'both', see lidar_lib.LIDAR_RETURNS
+                :param calibration_segments: number of segments whose laser
+                    geometry is cached, see calibration_segments
+        """
         self.__lidar_list = ['_FRONT', '_FRONT_RIGHT',
                              '_FRONT_LEFT', '_SIDE_RIGHT', '_SIDE_LEFT']
         self.__type_list = ['UNKNOWN', 'VEHICLE',
@@ -54,18 +104,40 @@ class Adapter:
         self.__file_names = []
         self.T_front_cam_to_ref = []
         self.T_vehicle_to_front_cam = []
-
-    def cvt(self, args, data_records, start_ind):
+        # time spent writing images and point clouds
+        self.write_seconds = 0.0
+        # buffers of the decompressed range images, reused for every frame
+        self.inflater = Inflater()
+        self.lidar_engine = lidar_engine
+        self.validate_lidar = validate_lidar
+        self.lidar_returns = lidar_returns
+        # GraphPointCloud of the tf_graph engine, created on first use
+        self.graph_point_cloud = None
+        # laser inclinations, extrinsics and pixel directions of the segments
+        self.calibration_cache = CalibrationCache(calibration_segments)
+        # float32 point clouds, reused for every frame
+        self.point_cloud_buffer = PointCloudBuffer()
+
+    def cvt(self, args, data_records, start_ind, raw_data_path=RAW_DATA_PATH):
         """ convert dataset from Waymo to KITTI
         Args:
         return:
         """
         self.start_ind = start_ind
-        self.set_file_names(RAW_DATA_PATH, data_records)
-        print("Converting ..." + RAW_DATA_PATH)
+        self.set_file_names(raw_data_path, data_records)
+        print("Converting ..." + raw_data_path)
+
+        self.metadata = MetadataCache(METADATA_PATH)
+        if args.dry_run:
+            return self.dry_run(args)
 
         self.create_folder(args.camera_type)
 
+        if args.frames is not None:
+            return self.cvt_frames(args, read_frame_list(args.frames))
+        if args.workers > 1 or args.num_shards > 1 or args.pipeline or args.interleave > 1:
+            return self.cvt_parallel(args)
+
         bar = progressbar.ProgressBar(maxval=len(self.__file_names) + 1,
                                       widgets=[progressbar.Percentage(), ' ',
                                                progressbar.Bar(
@@ -73,52 +145,624 @@ class Adapter:
                                                progressbar.ETA()])
 
         # tf.enable_eager_execution()
+        manifest = self.open_manifest(args)
         file_num = 1
         frame_num = 0
         frame_name = self.start_ind
-        label_exists = False
+        # first index of the block plan_segments gives the segment, the
+        # manifest key in both sequential and parallel runs
+        block = self.start_ind
         print("start converting ...")
         bar.start()
         for file_idx, file_name in enumerate(self.__file_names):
             print('File {}/{}'.format(file_idx, len(self.__file_names)))
-            dataset = tf.data.TFRecordDataset(file_name, compression_type='')
-            for data in dataset:
-                frame = open_dataset.Frame()
-                frame.ParseFromString(bytearray(data.numpy()))
-                if (frame_num % args.keyframe) == 0:
-                    if LOCATION_FILTER == True and frame.context.stats.location not in LOCATION_NAME:
-                        continue
-                    if args.test == False:
-                        label_exists = self.save_label(frame, frame_name, args.camera_type, False, True)
+            name = os.path.basename(file_name)
+            metadata = self.metadata.get(file_name, args.compression)
+            # the location is the same for every frame of a segment
+            excluded = LOCATION_FILTER == True and metadata['location'] not in LOCATION_NAME
+            entry = None
+            if not excluded:
+                segment_block = block
+                reserved = count_keyframes(
+                    frame_num, metadata['num_records'], args.keyframe)
+                block += reserved
+                entry = self.completed_entry(args, manifest, name, frame_num, segment_block)
+                # its frames must also follow the ones converted before it
+                if entry is not None and entry['start'] != frame_name:
+                    entry = None
+            if excluded:
+                print('File {} skipped, its location is filtered out'.format(name))
+                frame_num = advance_frame_num(
+                    frame_num, metadata['num_records'], args.keyframe, True)
+            elif entry is not None:
+                print('File {} already converted'.format(name))
+                frame_num, frame_name = entry['frame_num_end'], entry['end']
+            else:
+                # files of an earlier or interrupted run, at most one frame per keyframe
+                stale = manifest.remove(name)
+                keep = manifest.ranges(manifest.segments)
+                if stale is not None:
+                    self.clean_frames(stale['start'], stale['end'], keep)
+                self.check_block(manifest, frame_name, frame_name + reserved)
+                self.clean_frames(frame_name, frame_name + reserved, keep)
+                start_time = time.time()
+                end_frame_num, end_frame_name = self.convert_segment(
+                    args, file_name, frame_num, frame_name)
+                manifest.add(name, self.manifest_entry(
+                    frame_num, end_frame_num, segment_block, frame_name,
+                    end_frame_name - frame_name, time.time() - start_time))
+                frame_num, frame_name = end_frame_num, end_frame_name
+            bar.update(file_num)
+            file_num += 1
+        bar.finish()
+        self.metadata.save()
+        print("\nfinished ...")
+        return frame_name
 
-                    if args.test == label_exists:
-                        frame_num += 1
-                        continue
+    def watch(self, args, start_ind):
+        """ convert the .tfrecord files of args.inbox as they arrive, never
+        returns
+        The converted files and the next free frame index are kept in
+        WATCH_STATE_PATH, so a restarted watcher only converts new files.
+        A file is converted once its size has not changed for one poll.
+        """
+        inbox = args.inbox or RAW_DATA_PATH
+        state = read_json(WATCH_STATE_PATH, {'segments': [], 'next_ind': start_ind})
+        # frames converted before the watcher started, or after it stopped
+        state['next_ind'] = self.next_free_index(state['next_ind'])
+        seen = set(state['segments'])
+        sizes = {}
+        print("Watching ..." + inbox)
+        while True:
+            new_records = []
+            for file in sorted(os.listdir(inbox)):
+                if file.split('.')[-1] != 'tfrecord' or file in seen:
+                    continue
+                size = os.path.getsize(inbox + '/' + file)
+                if sizes.get(file) == size:
+                    new_records.append(file)
+                sizes[file] = size
+            if len(new_records) > 0:
+                adapter = Adapter(args.lidar_engine, args.validate_lidar, args.lidar_returns,
+                                  calibration_segments(args))
+                state['next_ind'] = adapter.cvt(
+                    args, new_records, state['next_ind'], inbox)
+                state['segments'] += new_records
+                seen.update(new_records)
+                write_json(WATCH_STATE_PATH, state)
+                print('{} new files, next frame index {}'.format(
+                    len(new_records), state['next_ind']))
+            time.sleep(args.poll_interval)
+
+    def next_free_index(self, start_ind):
+        """ start_ind, or the index after the last frame saved in KITTI_PATH
+        or recorded in a manifest if it is higher, from a full listing
+        """
+        saved = self.listed_frame_indices(0, 10 ** INDEX_LENGTH)
+        next_ind = max(start_ind, saved[-1] + 1 if len(saved) > 0 else 0)
+        if os.path.isdir(KITTI_PATH):
+            for file in os.listdir(KITTI_PATH):
+                if file.startswith('manifest') and file.endswith('.json'):
+                    for entry in read_json(KITTI_PATH + '/' + file)['segments'].values():
+                        next_ind = max(next_ind, entry['end'])
+        return next_ind
+
+    def cvt_frames(self, args, frames):
+        """ convert a list of frames of the segments, seeking to their records
+        with the index of every segment, see segment_index
+        The frames are saved in the order of the list from start_ind, the
+        keyframe setting is not applied.
+                :param frames: list of ('segment', file name, frame index) or
+                    ('context', context name, timestamp_micros), see
+                    read_frame_list
+                :return: the next free frame index
+        """
+        print("indexing segments ...")
+        # a context name can be in any segment, segment entries only need theirs
+        named = None
+        if all(kind == 'segment' for kind, _, _ in frames):
+            named = set(os.path.basename(key) for _, key, _ in frames)
+        indexes = {}
+        by_context = {}
+        for file_name in self.__file_names:
+            if named is not None and os.path.basename(file_name) not in named:
+                continue
+            index = segment_index(file_name, INDEX_PATH)
+            if LOCATION_FILTER == True and index['location'] not in LOCATION_NAME:
+                continue
+            indexes[os.path.basename(file_name)] = (file_name, index)
+            by_context[index['context_name']] = file_name
+        files = {}
+        frame_name = self.start_ind
+        try:
+            for kind, key, value in frames:
+                if kind == 'segment':
+                    if os.path.basename(key) not in indexes:
+                        raise ValueError('segment {} is not in the list to convert '
+                                         'or filtered out'.format(key))
+                    file_name, index = indexes[os.path.basename(key)]
+                    if not 0 <= value < len(index['records']):
+                        raise ValueError('segment {} has no frame {}'.format(key, value))
+                    offset, length, _ = index['records'][value]
+                else:
+                    if key not in by_context:
+                        raise ValueError('no segment with context {}, or it is '
+                                         'filtered out'.format(key))
+                    file_name, index = indexes[os.path.basename(by_context[key])]
+                    records = [record for record in index['records'] if record[2] == value]
+                    if len(records) == 0:
+                        raise ValueError('context {} has no frame at {}'.format(key, value))
+                    offset, length, _ = records[0]
+                if file_name not in files:
+                    files[file_name] = open(file_name, 'rb')
+                data = read_record(files[file_name], offset, length, file_name, args.check_crc)
+                # frame counter 0, every listed frame is a keyframe
+                _, frame_name = self.convert_record(args, data, 0, frame_name)
+        finally:
+            for f in files.values():
+                f.close()
+        print('{} of {} frames saved'.format(frame_name - self.start_ind, len(frames)))
+        return frame_name
 
-                    self.save_calib(frame, frame_name)
+    def cvt_parallel(self, args):
+        """ convert the segments of shard args.shard_id on a pool of
+        args.workers processes
+        Every segment is given the frame counter and a block of output indices
+        from a record-count pre-pass over all the segments, then the frames
+        saved by this shard are renumbered so that, for a single shard, the
+        output is the same as the one of a sequential run.
+        return: the next free frame index of the shard
+        """
+        planned_jobs, start_ind, end_ind = self.plan_jobs(args)
+        print('Shard {}/{}: {} files, frame indices [{}, {})'.format(
+            args.shard_id, args.num_shards, len(planned_jobs), start_ind, end_ind))
+        manifest = self.open_manifest(args)
+        jobs = self.resume_jobs(args, manifest, planned_jobs)
 
-                    self.save_label(
-                        frame, frame_name, args.camera_type)
+        bar = progressbar.ProgressBar(maxval=len(jobs) + 1,
+                                      widgets=[progressbar.Percentage(), ' ',
+                                               progressbar.Bar(
+                                                   marker='>', left='[', right=']'), ' ',
+                                               progressbar.ETA()])
+        if args.pipeline:
+            print("start converting with {} read, {} decode, {} compute, "
+                  "{} encode and {} write workers ...".format(*args.stage_workers))
+        elif args.workers == 1 and args.interleave > 1:
+            print("start converting, reading {} files at once ...".format(args.interleave))
+        else:
+            print("start converting with {} workers ...".format(args.workers))
+        bar.start()
+        pool = None
+        if args.pipeline:
+            results = self.pipeline_results(args, schedule_jobs(jobs))
+        elif args.autoscale:
+            results = self.autoscaled_results(args, schedule_jobs(jobs))
+        elif args.workers > 1:
+            jobs = schedule_jobs(jobs)
+            # spawn, TensorFlow does not survive a fork
+            pool = multiprocessing.get_context('spawn').Pool(
+                args.workers, set_thread_budget, (args.cores_per_worker,))
+            # chunks of one job, so the workers take the segments in order
+            results = pool.imap_unordered(
+                convert_segment_job, [(args, job) for job in jobs], 1)
+        elif args.interleave > 1:
+            results = self.interleaved_results(args, jobs)
+        else:
+            results = map(convert_segment_job, [(args, job) for job in jobs])
+        try:
+            for file_num, (job, num_saved, stats) in enumerate(results, 1):
+                print('File {}/{} saved {} frames'.format(
+                    job.index, len(self.__file_names), num_saved))
+                manifest.add(os.path.basename(job.file_name), self.manifest_entry(
+                    job.frame_num, advance_frame_num(job.frame_num, job.num_records, args.keyframe),
+                    job.frame_name, job.frame_name, num_saved,
+                    stats and stats['seconds'], job.reserved))
+                bar.update(file_num)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        bar.finish()
+        frame_name = start_ind + \
+            len(self.compact_frame_indices(start_ind, end_ind))
+        # the frames of every segment are now contiguous, in plan order
+        next_start = start_ind
+        for job in planned_jobs:
+            entry = manifest.segments.get(os.path.basename(job.file_name))
+            if job.reserved > 0 and entry is not None:
+                entry['start'] = next_start
+                entry['end'] = next_start + entry['num_saved']
+                entry['in_block'] = entry['start'] == job.frame_name
+                next_start = entry['end']
+        manifest.save()
+        print("\nfinished ...")
+        return frame_name
 
-                    # Save 2d labels labelled in image, NOT projected lidar labels
-                    # Does not handle args.camera_type == all
-                    self.save_cam_label(frame, frame_name, args.camera_type)
+    def open_manifest(self, args):
+        """ manifest of the segments already converted by this shard """
+        path = MANIFEST_PATH
+        if args.num_shards > 1:
+            path = KITTI_PATH + '/manifest_shard{}.json'.format(args.shard_id)
+        settings = {'keyframe': args.keyframe, 'camera_type': args.camera_type,
+                    'test': args.test}
+        # only set when not the default, so older manifests stay valid
+        if args.lidar_returns != 'first':
+            settings['lidar_returns'] = args.lidar_returns
+        return Manifest(path, settings, args.restart)
+
+    def manifest_entry(self, frame_num, frame_num_end, block, start, num_saved,
+                       seconds, reserved=None):
+        """ manifest entry of a converted segment, its frames are the ones saved
+        in [start, start + reserved), reserved defaults to num_saved
+        """
+        if reserved is None:
+            reserved = num_saved
+        return {'frame_num': frame_num, 'frame_num_end': frame_num_end,
+                'block': block, 'start': start, 'end': start + reserved,
+                'num_saved': num_saved, 'in_block': start == block,
+                'checksum': self.frames_checksum(start, start + reserved),
+                'seconds': seconds}
+
+    def completed_entry(self, args, manifest, name, frame_num, block):
+        """ manifest entry of a segment converted with the same plan, checked
+        against its output files with args.verify, None if it must be converted
+        """
+        entry = manifest.find(name, frame_num, block)
+        if entry is not None and args.verify:
+            if self.frames_checksum(entry['start'], entry['end']) != entry['checksum']:
+                print('File {} does not match the manifest, converting it again'.format(name))
+                entry = None
+        return entry
+
+    def check_block(self, manifest, start_ind, end_ind):
+        """ raise ValueError if the manifest records frames in [start_ind,
+        end_ind) of a segment that is not being converted, they would be
+        overwritten
+        """
+        names = set(os.path.basename(file_name) for file_name in self.__file_names)
+        for name, entry in manifest.segments.items():
+            if name not in names and entry['start'] < end_ind and start_ind < entry['end']:
+                raise ValueError('frames [{}, {}) would overwrite the frames [{}, {}) of {}, '
+                                 'start after them with --start_ind'.format(
+                                     start_ind, end_ind, entry['start'], entry['end'], name))
+
+    def resume_jobs(self, args, manifest, jobs):
+        """ planned jobs that are not completed yet, with the files of their
+        interrupted runs removed
+        """
+        jobs = [job for job in jobs if job.reserved > 0]
+        done = [self.completed_entry(args, manifest, os.path.basename(job.file_name),
+                                     job.frame_num, job.frame_name) is not None
+                for job in jobs]
+        if False in done:
+            first_todo = done.index(False)
+            for i in range(first_todo + 1, len(jobs)):
+                name = os.path.basename(jobs[i].file_name)
+                # renumbered frames of a later segment can sit in the block
+                # of a segment that is converted again
+                if done[i] and manifest.segments[name]['in_block'] == False:
+                    done[i] = False
+        kept = [os.path.basename(job.file_name) for job, job_done in zip(jobs, done) if job_done]
+        todo = []
+        for job, job_done in zip(jobs, done):
+            if job_done:
+                continue
+            stale = manifest.remove(os.path.basename(job.file_name))
+            self.check_block(manifest, job.frame_name, job.frame_name + job.reserved)
+            if stale is not None:
+                self.clean_frames(stale['start'], stale['end'], manifest.ranges(kept))
+            self.clean_frames(job.frame_name, job.frame_name + job.reserved,
+                              manifest.ranges(kept))
+            todo.append(job)
+        manifest.save()
+        if len(todo) < len(jobs):
+            print('{} files already converted'.format(len(jobs) - len(todo)))
+        return todo
+
+    def plan_jobs(self, args):
+        """ plan the segments of shard args.shard_id, see plan_segments
+        return: the jobs of the shard and its [start, end) frame index range
+        """
+        print("reading segment metadata ...")
+        metadata = [self.metadata.get(file_name, args.compression)
+                    for file_name in self.__file_names]
+        self.metadata.save()
+        excluded = None
+        if LOCATION_FILTER == True:
+            excluded = [segment['location'] not in LOCATION_NAME for segment in metadata]
+        jobs = plan_segments(self.__file_names, [segment['num_records'] for segment in metadata],
+                             args.keyframe, self.start_ind, excluded)
+        jobs = shard_jobs(jobs, args.num_shards, args.shard_id)
+        start_ind = jobs[0].frame_name if jobs else self.start_ind
+        end_ind = jobs[-1].frame_name + jobs[-1].reserved if jobs else self.start_ind
+        return jobs, start_ind, end_ind
+
+    def dry_run(self, args):
+        """ report the frames, disk usage and time a conversion with the
+        current settings would take, from the segment metadata, nothing is
+        converted
+        Training frames are counted when they have lidar labelled objects,
+        whether the selected camera sees them is only known once converted.
+        The time is the one per frame of the segments in the manifest.
+                :return: start_ind
+        """
+        jobs, _, _ = self.plan_jobs(args)
+        print('{:<60} {:>8} {:>10} {:>8}  {}'.format(
+            'file', 'records', 'keyframes', 'frames', 'location / time of day'))
+        total_frames = 0
+        for job in jobs:
+            metadata = self.metadata.get(job.file_name, args.compression)
+            objects = [metadata['laser_objects'][i] for i in range(job.num_records)
+                       if job.reserved > 0 and (job.frame_num + i) % args.keyframe == 0]
+            frames = len(objects) if args.test else sum(1 for n in objects if n > 0)
+            total_frames += frames
+            print('{:<60} {:>8} {:>10} {:>8}  {} / {}'.format(
+                os.path.basename(job.file_name), job.num_records, len(objects), frames,
+                metadata['location'], metadata['time_of_day']))
+        frame_bytes = self.average_frame_bytes()
+        print('\n{} files, at most {} frames'.format(len(jobs), total_frames))
+        print('Disk usage: {:.1f} GB ({:.1f} MB per frame{})'.format(
+            total_frames * frame_bytes / (1 << 30), frame_bytes / (1 << 20),
+            '' if os.path.isdir(LIDAR_PATH) else ', assumed'))
+        manifest = self.open_manifest(args)
+        timed = [entry for entry in manifest.segments.values() if entry['seconds'] is not None]
+        timed_frames = sum(entry['num_saved'] for entry in timed)
+        if timed_frames > 0:
+            seconds = total_frames * sum(entry['seconds'] for entry in timed) / timed_frames
+            print('Time: {:.1f} h with one worker, {:.1f} h with {} workers'.format(
+                seconds / 3600, seconds / 3600 / args.workers, args.workers))
+        else:
+            print('Time: unknown, no timed segment in the manifest yet')
+        return self.start_ind
 
-                    self.save_image(frame, frame_name, args.camera_type)
+    def average_frame_bytes(self):
+        """ disk usage of the frames already converted, FRAME_BYTES_ESTIMATE
+        if there are none
+        """
+        if not os.path.isdir(LIDAR_PATH):
+            return FRAME_BYTES_ESTIMATE
+        total = 0
+        frames = self.listed_frame_indices(0, 10 ** INDEX_LENGTH)
+        for frame_num in frames:
+            for path in self.output_paths(frame_num):
+                if os.path.exists(path):
+                    total += os.path.getsize(path)
+        return total / len(frames) if len(frames) > 0 else FRAME_BYTES_ESTIMATE
+
+    def read_segment(self, args, file_name):
+        """ records of a segment, read ahead in a background thread """
+        records = iter_records(file_name, args.read_buffer_mb << 20,
+                               args.check_crc, args.mmap, args.compression)
+        return prefetch(records, args.prefetch)
+
+    def read_segments(self, args, jobs):
+        """ (job index, record) of several segments read in parallel,
+        args.interleave segments at a time, the records of a segment stay in
+        order
+        """
+        pending = collections.deque(jobs)
+        readers = collections.deque()
+        while len(pending) > 0 or len(readers) > 0:
+            # a finished segment is replaced by the next one
+            while len(pending) > 0 and len(readers) < args.interleave:
+                job = pending.popleft()
+                readers.append((job.index, self.read_segment(args, job.file_name)))
+            index, records = readers.popleft()
+            data = next(records, None)
+            if data is None:
+                continue
+            yield index, data
+            readers.append((index, records))
+
+    def autoscaled_results(self, args, jobs):
+        """ convert the segments on a pool of up to args.workers processes,
+        the number of segments converted at once is tuned between segments by
+        an AutoScaler
+                :return: iterator of (job, number of saved frames, stats), see
+                    convert_segment_job
+        """
+        scaler = AutoScaler(args.workers)
+        print('Autoscale: starting with {} workers'.format(scaler.workers))
+        pool = multiprocessing.get_context('spawn').Pool(
+            args.workers, set_thread_budget, (args.cores_per_worker,))
+        done = queue.Queue()
+        pending = list(jobs)
+        running = 0
+        try:
+            while len(pending) > 0 or running > 0:
+                while len(pending) > 0 and running < scaler.workers:
+                    pool.apply_async(convert_segment_job, ((args, pending.pop(0)),),
+                                     callback=done.put, error_callback=done.put)
+                    running += 1
+                result = done.get()
+                running -= 1
+                if isinstance(result, BaseException):
+                    raise result
+                job, _, stats = result
+                workers = scaler.workers
+                scaler.update(job.reserved, stats['write_seconds'])
+                if scaler.workers != workers:
+                    print('Autoscale: {} workers, {:.2f} frames/s'.format(
+                        scaler.workers, scaler.throughput))
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def interleaved_results(self, args, jobs):
+        """ convert planned segments in this process while reading
+        args.interleave of them at once
+                :return: iterator of (job, number of saved frames, None)
+        """
+        jobs = {job.index: job for job in jobs}
+        state = {index: (job.frame_num, job.frame_name, 0) for index, job in jobs.items()}
+        for index, data in self.read_segments(args, list(jobs.values())):
+            frame_num, frame_name, num_read = state[index]
+            frame_num, frame_name = self.convert_record(args, data, frame_num, frame_name)
+            state[index] = (frame_num, frame_name, num_read + 1)
+            job = jobs[index]
+            if num_read + 1 == job.num_records:
+                yield job, frame_name - job.frame_name, None
+
+    def convert_segment(self, args, file_name, frame_num, frame_name, save_frame=None):
+        """ convert the frames of one tfrecord segment
+                :param file_name: path of the .tfrecord file
+                :param frame_num: number of records seen before this segment
+                :param frame_name: index of the first frame saved from this segment
+                :param save_frame: called as save_frame(args, decoded, frame_name)
+                    with the DecodedFrame of every kept frame, default is
+                    self.save_frame
+                :return: the updated frame_num and frame_name
+        """
+        for data in self.read_segment(args, file_name):
+            frame_num, frame_name = self.convert_record(
+                args, data, frame_num, frame_name, save_frame)
+        return frame_num, frame_name
+
+    def convert_record(self, args, data, frame_num, frame_name, save_frame=None):
+        """ convert one record of a segment
+                :param data: bytes or buffer of the serialized frame
+                :return: the updated frame_num and frame_name
+        """
+        if save_frame is None:
+            save_frame = self.save_frame
+        # the keyframe filter is applied before parsing, most records are
+        # skipped, segments rejected by the location filter are never read
+        if (frame_num % args.keyframe) != 0:
+            return frame_num + 1, frame_name
+        frame = self.parse_frame(data, args.camera_type)
+        decoded = DecodedFrame(self, frame)
+        label_exists = False
+        if args.test == False:
+            # the labels are kept by decoded and written by save_frame
+            label_exists = decoded.labels(args.camera_type) is not None
 
-                    self.save_lidar(frame, frame_name)
+        if args.test == label_exists:
+            return frame_num + 1, frame_name
 
-                    self.save_image_calib(frame, frame_name)
+        save_frame(args, decoded, frame_name)
+        return frame_num + 1, frame_name + 1
 
-                    # print("image:{}\ncalib:{}\nlidar:{}\nlabel:{}\n".format(str(s1-e1),str(s2-e2),str(s3-e3),str(s4-e4)))
-                    frame_name += 1
+    def parse_frame(self, data, cam_type):
+        """ parse a serialized frame without the fields the conversion does not
+        use, see select_frame
+                :param data: bytes or buffer of the frame
+                :return: open dataset frame proto
+        """
+        cameras = None if cam_type == 'all' else {int(cam_type) + 1}
+        frame = open_dataset.Frame()
+        frame.ParseFromString(select_frame(
+            data, cameras, second_returns=self.lidar_returns != 'first'))
+        return frame
+
+    def save_frame(self, args, decoded, frame_name):
+        """ save every output of a frame
+                :param decoded: DecodedFrame of the frame
+        """
+        frame = decoded.frame
+        self.save_calib(frame, frame_name)
 
-                frame_num += 1
-            bar.update(file_num)
-            file_num += 1
-        bar.finish()
-        print("\nfinished ...")
-        return frame_name
+        labels = decoded.labels(args.camera_type)
+        if labels is not None:
+            self.write_labels(labels, frame_name)
+
+        # Save 2d labels labelled in image, NOT projected lidar labels
+        # Does not handle args.camera_type == all
+        self.save_cam_label(frame, frame_name, args.camera_type)
+
+        self.save_image(frame, frame_name, args.camera_type)
+
+        self.save_lidar(frame, frame_name, decoded.point_cloud)
+
+        self.save_image_calib(frame, frame_name)
+
+        # print("image:{}\ncalib:{}\nlidar:{}\nlabel:{}\n".format(str(s1-e1),str(s2-e2),str(s3-e3),str(s4-e4)))
+
+    def text_outputs(self, args, decoded, frame_name):
+        """ text files saved for a frame by save_frame
+                :param decoded: DecodedFrame of the frame
+                :return: dict of {path: content}
+        """
+        frame = decoded.frame
+        name = str(frame_name).zfill(INDEX_LENGTH)
+        texts = {CALIB_PATH + '/' + name + '.txt': self.calib_content(frame)}
+        labels = decoded.labels(args.camera_type)
+        if labels is not None:
+            texts[LABEL_PATH + '/' + name + '.txt'] = labels[0]
+            texts[LABEL_ALL_PATH + '/' + name + '.txt'] = labels[1]
+        texts[CAM_LABEL_PATH + '/' + name + '.txt'] = self.cam_label_content(
+            frame, args.camera_type)
+        texts[IMG_CALIB_PATH + '/' + name + '.txt'] = self.image_calib_content(frame)
+        return texts
+
+    def ring_slot_bytes(self, args, jobs):
+        """ slot size in bytes of every shared memory ring of pipeline_results,
+        from the largest payload of the ring, args.slot_mb for all of them if
+        it is set
+        """
+        names = ['record', 'decoded', 'lidar', 'image']
+        if args.slot_mb is not None:
+            return {name: args.slot_mb << 20 for name in names}
+        # the second returns are only dropped by select_frame with 'first'
+        decoded_returns = 1 if args.lidar_returns == 'first' else 2
+        returns = len(LIDAR_RETURNS[args.lidar_returns])
+        columns = 6 if returns > 1 else 5
+        # records vary in size, twice the average of the segment with the
+        # largest ones
+        record_bytes = max([2 * os.path.getsize(job.file_name) // max(job.num_records, 1)
+                            for job in jobs], default=0)
+        sizes = {'record': max(record_bytes, RECORD_SLOT_BYTES),
+                 'decoded': decoded_returns * RANGE_IMAGES_BYTES + TOP_POSE_BYTES + IMAGE_BYTES,
+                 # every pixel of the range images is a point at most
+                 'lidar': returns * RANGE_IMAGE_PIXELS * columns * 4,
+                 # a png can be larger than the raw image
+                 'image': IMAGE_BYTES * 4 // 3}
+        # 10% for the alignment of the arrays and larger images
+        return {name: int(sizes[name] * 1.1) for name in names}
+
+    def pipeline_results(self, args, jobs):
+        """ convert the segments with a read -> decode -> compute -> encode ->
+        write pipeline, args.stage_workers processes per stage
+        Arrays are handed from a stage to the next in shared memory rings of
+        args.ring_slots frames, at most args.queue_size frames wait between two
+        stages, so a slow stage throttles the ones before it.
+                :return: iterator of (job, number of saved frames, None), a job
+                    is yielded once all its frames are written, see
+                    convert_segment_job
+        """
+        ctx = multiprocessing.get_context('spawn')
+        slot_bytes = self.ring_slot_bytes(args, jobs)
+        print('Shared memory: {:.0f} MB, {} slots of {}'.format(
+            args.ring_slots * sum(slot_bytes.values()) / (1 << 20), args.ring_slots,
+            ', '.join('{:.1f} MB for {}'.format(size / (1 << 20), name)
+                      for name, size in slot_bytes.items())))
+        rings = {name: SharedArrayRing(ctx, args.ring_slots, size)
+                 for name, size in slot_bytes.items()}
+        setup = functools.partial(PipelineWorker, args, rings)
+        stage_fns = [PipelineWorker.read, PipelineWorker.decode,
+                     PipelineWorker.compute, PipelineWorker.encode,
+                     PipelineWorker.write]
+        stages = [Stage(fn, workers, setup)
+                  for fn, workers in zip(stage_fns, args.stage_workers)]
+        processed = collections.Counter()
+        saved = collections.Counter()
+        finished = {}
+        try:
+            for item in run_pipeline(ctx, stages, jobs, args.queue_size):
+                if item[0] == 'frame':
+                    _, index, frame_saved = item
+                    processed[index] += 1
+                    saved[index] += frame_saved
+                else:
+                    _, job, num_frames = item
+                    index = job.index
+                    finished[index] = (job, num_frames)
+                if index in finished and processed[index] == finished[index][1]:
+                    job, _ = finished.pop(index)
+                    yield job, saved.pop(index, 0), None
+        finally:
+            for ring in rings.values():
+                ring.unlink()
 
     def save_image(self, frame, frame_num, cam_type):
         """ parse and save the images in png format
@@ -126,14 +770,42 @@ class Adapter:
                 :param frame_num: the current frame number
                 :return:
         """
+        rgb_img = self.decode_image(frame, cam_type)
+        if rgb_img is not None:
+            self.write_image(rgb_img, frame_num)
+
+    def decode_image(self, frame, cam_type):
+        """ decode the image saved for a frame
+                :param frame: open dataset frame proto
+                :return: RGB image, None if no camera matches cam_type
+        """
+        rgb_img = None
+        # with cam_type 'all' every image goes to the same file, the last one is kept
         for img in frame.images:
             if cam_type == 'all' or cam_type == str(img.name - 1):
-                img_path = IMAGE_PATH + '/' + \
-                    str(frame_num).zfill(INDEX_LENGTH) + '.' + IMAGE_FORMAT
                 img = cv2.imdecode(np.frombuffer(
                     img.image, np.uint8), cv2.IMREAD_COLOR)
                 rgb_img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-                plt.imsave(img_path, rgb_img, format=IMAGE_FORMAT)
+        return rgb_img
+
+    def write_image(self, rgb_img, frame_num):
+        self.write_encoded_image(self.encode_image(rgb_img), frame_num)
+
+    def encode_image(self, rgb_img):
+        """ encode an image the way write_image saves it
+                :return: bytes of the image file
+        """
+        buffer = io.BytesIO()
+        plt.imsave(buffer, rgb_img, format=IMAGE_FORMAT)
+        return buffer.getvalue()
+
+    def write_encoded_image(self, data, frame_num):
+        img_path = IMAGE_PATH + '/' + \
+            str(frame_num).zfill(INDEX_LENGTH) + '.' + IMAGE_FORMAT
+        start_time = time.time()
+        with open(img_path, 'wb') as f:
+            f.write(data)
+        self.write_seconds += time.time() - start_time
 
     def save_calib(self, frame, frame_num, kitti_format=True):
         """ parse and save the calibration data
@@ -143,12 +815,16 @@ class Adapter:
         """
         fp_calib = open(CALIB_PATH + '/' +
                         str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
+        fp_calib.write(self.calib_content(frame))
+        fp_calib.close()
 
-        self.T_front_cam_to_ref = np.array([
-            [0.0, -1.0, 0.0],
-            [0.0, 0.0, -1.0],
-            [1.0, 0.0, 0.0]
-        ])
+    def calib_content(self, frame):
+        """ calibration file of a frame, also sets the camera transforms used by
+        the labels
+                :param frame: open dataset frame proto
+                :return: content of the calib .txt file
+        """
+        self.set_camera_transforms(frame)
 
         camera_calib = []
         R0_rect = ["%e" % i for i in np.eye(3).flatten()]
@@ -171,9 +847,6 @@ class Adapter:
             tmp = ["%e" % i for i in tmp]
             camera_calib.append(tmp)
 
-        T_front_cam_to_vehicle = np.array(frame.context.camera_calibrations[0].extrinsic.transform).reshape(4, 4)
-        self.T_vehicle_to_front_cam = np.linalg.inv(T_front_cam_to_vehicle)
-
         for i in range(5):
             calib_context += "P" + str(i) + ": " + \
                 " ".join(camera_calib[i]) + '\n'
@@ -184,48 +857,163 @@ class Adapter:
         calib_context += "timestamp_micros: " + \
             str(frame.timestamp_micros) + '\n'
         calib_context += "context_name: " + str(frame.context.name) + '\n'
-        fp_calib.write(calib_context)
-        fp_calib.close()
+        return calib_context
 
-    def save_lidar(self, frame, frame_num):
+    def set_camera_transforms(self, frame):
+        """ set the transforms from the vehicle to the front camera frame used
+        by the labels
+                :param frame: open dataset frame proto
+        """
+        self.T_front_cam_to_ref = np.array([
+            [0.0, -1.0, 0.0],
+            [0.0, 0.0, -1.0],
+            [1.0, 0.0, 0.0]
+        ])
+        T_front_cam_to_vehicle = np.array(frame.context.camera_calibrations[0].extrinsic.transform).reshape(4, 4)
+        self.T_vehicle_to_front_cam = np.linalg.inv(T_front_cam_to_vehicle)
+
+    def save_lidar(self, frame, frame_num, point_cloud=None):
         """ parse and save the lidar data in psd format
                 :param frame: open dataset frame proto
                 :param frame_num: the current frame number
+                :param point_cloud: point cloud of the frame, computed if None
                 :return:
                 """
-        range_images, range_image_top_pose = self.parse_range_image_and_camera_projection(
-            frame)
-
-        points, intensity, elongation = self.convert_range_image_to_point_cloud(
-            frame,
-            range_images,
-            range_image_top_pose)
-        points_all = np.concatenate(points, axis=0)
-        intensity_all = np.concatenate(intensity, axis=0)
-        elongation_all = np.concatenate(elongation, axis=0)
-        point_cloud = np.column_stack((points_all, intensity_all, elongation_all))
+        if point_cloud is None:
+            point_cloud = self.get_point_cloud(frame)
+        self.write_lidar(point_cloud, frame_num)
+
+    def get_point_cloud(self, frame, range_images=None, range_image_top_pose=None,
+                        returns=None):
+        """ point cloud of a frame
+                :param frame: open dataset frame proto
+                :param range_images: decoded range images of the frame, see
+                    parse_range_image_and_camera_projection, parsed from the
+                    frame if None
+                :param returns: indices of the range image returns, those of
+                    --lidar_returns if None
+                :return: [N, 5] array of x, y, z, intensity, elongation, with
+                    --lidar_returns both [N, 6] with the return index (0 or
+                    1) in the last column, the points of the first returns
+                    come first, float32 in a buffer reused by the next frame
+        """
+        if range_images is None:
+            range_images, range_image_top_pose = self.parse_range_image_and_camera_projection(
+                frame)
+
+        if returns is None:
+            returns = LIDAR_RETURNS[self.lidar_returns]
+        point_cloud = self.compute_point_cloud(
+            frame, range_images, range_image_top_pose, self.lidar_engine, returns)
+        if self.validate_lidar:
+            other_engine = 'numpy' if self.lidar_engine == 'tf' else 'tf'
+            compare_point_clouds(point_cloud, self.compute_point_cloud(
+                frame, range_images, range_image_top_pose, other_engine, returns))
+        return point_cloud
+
+    def label_points(self, frame, point_cloud=None, range_images=None,
+                     range_image_top_pose=None):
+        """ first return points of a frame, the points counted in the label
+        boxes whatever --lidar_returns saves
+                :param point_cloud: get_point_cloud of the frame, computed if
+                    None and needed
+                :return: [N, 5] or [N, 6] array, see get_point_cloud
+        """
+        if self.lidar_returns == 'second':
+            if range_images is None:
+                range_images, range_image_top_pose = \
+                    self.parse_range_image_and_camera_projection(frame)
+            return self.get_point_cloud(frame, range_images, range_image_top_pose, returns=(0,))
+        if point_cloud is None:
+            point_cloud = self.get_point_cloud(frame, range_images, range_image_top_pose)
+        if self.lidar_returns == 'both':
+            # return major, the first returns come first
+            return point_cloud[:np.searchsorted(point_cloud[:, 5], 0, side='right')]
+        return point_cloud
+
+    def compute_point_cloud(self, frame, range_images, range_image_top_pose, engine, returns):
+        """ point cloud of a frame computed by one engine, see get_point_cloud """
+        geometries = self.calibration_cache.get(frame, range_images)
+        if engine == 'numpy':
+            frame_pose = np.reshape(np.array(frame.pose.transform), [4, 4])
+            points, intensity, elongation = range_images_to_point_cloud(
+                geometries, range_images, range_image_top_pose, frame_pose, returns)
+        elif engine == 'tf_graph':
+            if self.graph_point_cloud is None:
+                load_tensorflow()
+                from lidar_tf_lib import GraphPointCloud
+                self.graph_point_cloud = GraphPointCloud()
+            frame_pose = np.reshape(np.array(frame.pose.transform), [4, 4])
+            points, intensity, elongation = self.graph_point_cloud(
+                geometries, range_images, range_image_top_pose, frame_pose, returns)
+        else:
+            points, intensity, elongation = self.convert_range_image_to_point_cloud(
+                frame,
+                range_images,
+                range_image_top_pose,
+                returns,
+                geometries=geometries)
+        return_index = None
+        if len(returns) > 1:
+            # the lists hold the same number of items for every return
+            per_return = len(points) // len(returns)
+            return_index = [returns[i // per_return] for i in range(len(points))]
+        return self.point_cloud_buffer.assemble(
+            (engine, returns), points, intensity, elongation, return_index)
+
+    def write_lidar(self, point_cloud, frame_num):
         pc_path = LIDAR_PATH + '/' + \
             str(frame_num).zfill(INDEX_LENGTH) + '.bin'
+        start_time = time.time()
         point_cloud.tofile(pc_path)
+        self.write_seconds += time.time() - start_time
 
-    def save_label(self, frame, frame_num, cam_type, kitti_format=False, check_label_exists = False):
+    def save_label(self, frame, frame_num, cam_type, kitti_format=False, check_label_exists = False,
+                   point_cloud=None):
         """ parse and save the label data in .txt format
                 :param frame: open dataset frame proto
                 :param frame_num: the current frame number
+                :param point_cloud: point cloud of the frame, computed if None
                 :return:
                 """
+        labels = self.label_content(frame, cam_type, check_label_exists, point_cloud)
+        if labels is None:
+            return False
+        self.write_labels(labels, frame_num)
+        return True
 
+    def write_labels(self, labels, frame_num):
+        """ save the label and label_all files of a frame
+                :param labels: label_content of the frame
+        """
+        label_lines, label_all_lines = labels
+        fp_label_all = open(LABEL_ALL_PATH + '/' +
+                        str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
+        fp_label = open(LABEL_PATH + '/' +
+                            str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
+        fp_label.write(label_lines)
+        fp_label.close()
+        fp_label_all.write(label_all_lines)
+        fp_label_all.close()
 
-        # get point cloud in the frame
-        range_images, range_image_top_pose = self.parse_range_image_and_camera_projection(
-            frame)
-
-        points, intensity, elongation = self.convert_range_image_to_point_cloud(
-            frame,
-            range_images,
-            range_image_top_pose)
-        points_all = tf.convert_to_tensor(
-            np.concatenate(points, axis=0), dtype=np.float32)
+    def label_content(self, frame, cam_type, check_label_exists=False, point_cloud=None,
+                      range_images=None, range_image_top_pose=None):
+        """ label files of a frame
+                :param frame: open dataset frame proto
+                :param point_cloud: point cloud of the frame, computed if None
+                :param range_images: decoded range images of the frame, see
+                    get_point_cloud
+                :return: content of the label and label_all .txt files, None
+                    if no object is seen by the camera
+        """
+        if check_label_exists == False:
+            self.set_camera_transforms(frame)
+        # get point cloud in the frame, the boxes count the first returns
+        point_cloud = self.label_points(frame, point_cloud, range_images, range_image_top_pose)
+        if self.lidar_engine != 'numpy':
+            load_tensorflow()
+            points_all = tf.convert_to_tensor(
+                point_cloud[:, :3], dtype=np.float32)
 
         # preprocess bounding box data
         id_to_bbox = dict()
@@ -266,12 +1054,15 @@ class Adapter:
                     break
             if bounding_box == None or name == None:
                 continue
-            box = tf.convert_to_tensor(
-                [obj.box.center_x, obj.box.center_y, obj.box.center_z, obj.box.length, obj.box.width, obj.box.height, obj.box.heading], dtype=np.float32)
-            box = tf.reshape(box, (1, 7))
-            num_points = box_utils.compute_num_points_in_box_3d(
-                points_all, box)
-            num_points = num_points.numpy()[0]
+            box = [obj.box.center_x, obj.box.center_y, obj.box.center_z, obj.box.length, obj.box.width, obj.box.height, obj.box.heading]
+            if self.lidar_engine == 'numpy':
+                num_points = count_points_in_box(point_cloud, box)
+            else:
+                box = tf.convert_to_tensor(box, dtype=np.float32)
+                box = tf.reshape(box, (1, 7))
+                num_points = box_utils.compute_num_points_in_box_3d(
+                    points_all, box)
+                num_points = num_points.numpy()[0]
             detection_difficulty = obj.detection_difficulty_level
             my_type = self.__type_list[obj.type]
             truncated = 0
@@ -329,17 +1120,8 @@ class Adapter:
                 recorded_label.append(line)
 
         if len(recorded_label) == 0:
-            return False
-        else:
-            fp_label_all = open(LABEL_ALL_PATH + '/' +
-                            str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
-            fp_label = open(LABEL_PATH + '/' +
-                                str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
-            fp_label.write(label_lines)
-            fp_label.close()
-            fp_label_all.write(label_all_lines)
-            fp_label_all.close()
-            return True
+            return None
+        return label_lines, label_all_lines
 
     def save_cam_label(self, frame, frame_num, cam_type, kitti_format=False, check_label_exists = False):
         """ parse and save the label data in .txt format
@@ -347,8 +1129,16 @@ class Adapter:
                 :param frame_num: the current frame number
                 :return:
                 """
+        fp_label = open(CAM_LABEL_PATH + '/' +
+                            str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
+        fp_label.write(self.cam_label_content(frame, cam_type))
+        fp_label.close()
 
-
+    def cam_label_content(self, frame, cam_type):
+        """ 2d labels of the camera images of a frame
+                :param frame: open dataset frame proto
+                :return: content of the cam_label .txt file
+        """
         label_lines = ''
         recorded_label = []
         cam_type = int(cam_type)
@@ -383,14 +1173,19 @@ class Adapter:
                     1.0)
                 label_lines += line
                 recorded_label.append(line)
-        fp_label = open(CAM_LABEL_PATH + '/' +
-                            str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
-        fp_label.write(label_lines)
-        fp_label.close()
-            
+        return label_lines
+
     def save_image_calib(self, frame, frame_num):
         fp_image_calib = open(IMG_CALIB_PATH + '/' +
                               str(frame_num).zfill(INDEX_LENGTH) + '.txt', 'w+')
+        fp_image_calib.write(self.image_calib_content(frame))
+        fp_image_calib.close()
+
+    def image_calib_content(self, frame):
+        """ camera poses and timings of a frame
+                :param frame: open dataset frame proto
+                :return: content of the img_calib .txt file
+        """
         camera_calib = []
         pose = []
         velocity = []
@@ -434,8 +1229,7 @@ class Adapter:
         for i in range(5):
             calib_context += "Readout_" + str(i) + ": " + \
                 " ".join(velocity[i]) + '\n'
-        fp_image_calib.write(calib_context)
-        fp_image_calib.close()
+        return calib_context
 
     def set_file_names(self, raw_data_path, data_records):
         for data_record in data_records:
@@ -456,6 +1250,81 @@ class Adapter:
             raise ValueError(mat.shape)
         return ret
 
+    def output_paths(self, frame_num):
+        """ paths of every file that can be saved for a frame """
+        name = str(frame_num).zfill(INDEX_LENGTH)
+        return [CALIB_PATH + '/' + name + '.txt',
+                LIDAR_PATH + '/' + name + '.bin',
+                LABEL_ALL_PATH + '/' + name + '.txt',
+                IMG_CALIB_PATH + '/' + name + '.txt',
+                IMAGE_PATH + '/' + name + '.' + IMAGE_FORMAT,
+                LABEL_PATH + '/' + name + '.txt',
+                CAM_LABEL_PATH + '/' + name + '.txt']
+
+    def saved_frame_indices(self, start_ind, end_ind):
+        """ sorted indices in [start_ind, end_ind) that have at least one saved
+        file, the expected files of every index are checked, for a small range
+        """
+        return [frame_num for frame_num in range(start_ind, end_ind)
+                if any(os.path.exists(path) for path in self.output_paths(frame_num))]
+
+    def listed_frame_indices(self, start_ind, end_ind):
+        """ same as saved_frame_indices from a full listing of the output
+        folders, for the whole output: the next free index of a watcher at
+        startup and the disk usage estimate of --dry_run
+        """
+        dirs = set(os.path.dirname(path) for path in self.output_paths(0))
+        saved = set()
+        for dir in dirs:
+            if not os.path.isdir(dir):
+                continue
+            for file in os.listdir(dir):
+                stem = file.split('.')[0]
+                if stem.isdigit() and start_ind <= int(stem) < end_ind:
+                    saved.add(int(stem))
+        return sorted(saved)
+
+    def compact_frame_indices(self, start_ind, end_ind):
+        """ renumber the frames saved in [start_ind, end_ind) so that they are
+        contiguous from start_ind, keeping their order
+                :return: dict mapping the old to the new frame index
+        """
+        mapping = {}
+        for new, old in enumerate(self.saved_frame_indices(start_ind, end_ind), start_ind):
+            mapping[old] = new
+            # new <= old and every index below old is already final
+            if new == old:
+                continue
+            for old_path, new_path in zip(self.output_paths(old), self.output_paths(new)):
+                if os.path.exists(old_path):
+                    os.rename(old_path, new_path)
+        return mapping
+
+    def clean_frames(self, start_ind, end_ind, keep=()):
+        """ remove the files saved for the frames in [start_ind, end_ind)
+                :param keep: list of [start, end) ranges of frames to keep
+        """
+        for frame_num in self.saved_frame_indices(start_ind, end_ind):
+            if any(start <= frame_num < end for start, end in keep):
+                continue
+            for path in self.output_paths(frame_num):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def frames_checksum(self, start_ind, end_ind):
+        """ md5 of the files saved for the frames in [start_ind, end_ind), it
+        does not depend on the frame indices
+        """
+        md5 = hashlib.md5()
+        for frame_num in self.saved_frame_indices(start_ind, end_ind):
+            for path in self.output_paths(frame_num):
+                if os.path.exists(path):
+                    md5.update(os.path.basename(os.path.dirname(path)).encode())
+                    with open(path, 'rb') as f:
+                        for block in iter(lambda: f.read(1 << 20), b''):
+                            md5.update(block)
+        return md5.hexdigest()
+
     def create_folder(self, cam_type):
         dirs = [KITTI_PATH, CALIB_PATH, LIDAR_PATH, LABEL_ALL_PATH, IMG_CALIB_PATH, IMAGE_PATH, LABEL_PATH, CAM_LABEL_PATH]
         for dir in dirs:
@@ -468,14 +1337,15 @@ class Adapter:
                 :param lidar_num: the number of current lidar
                 :return:
                 """
-        intensity_0 = np.array(range_images[lidar_num][0].data).reshape(-1, 4)
+        intensity_0 = range_images[lidar_num][0].reshape(-1, 4)
         intensity_0 = intensity_0[:, 1]
-        intensity_1 = np.array(range_images[lidar_num][
-                               1].data).reshape(-1, 4)[:, 1]
+        intensity_1 = range_images[lidar_num][
+                               1].reshape(-1, 4)[:, 1]
         return intensity_0, intensity_1
 
     def image_show(self, data, name, layout, cmap=None):
         """Show an image."""
+        load_tensorflow()
         plt.subplot(*layout)
         plt.imshow(tf.image.decode_jpeg(data), cmap=cmap)
         plt.title(name)
@@ -488,29 +1358,25 @@ class Adapter:
            frame: open dataset frame proto
         Returns:
            range_images: A dict of {laser_name,
-             [range_image_first_return, range_image_second_return]}.
+             [range_image_first_return, range_image_second_return]},
+             every range image is a [H, W, 4] float32 array. The arrays
+             are views of buffers reused by the next call.
            camera_projections: A dict of {laser_name,
              [camera_projection_from_first_return,
               camera_projection_from_second_return]}.
-          range_image_top_pose: range image pixel pose for top lidar.
+          range_image_top_pose: [H, W, 6] range image pixel pose for top lidar.
         """
         self.__range_images = {}
         # camera_projections = {}
         # range_image_top_pose = None
         for laser in frame.lasers:
             if len(laser.ri_return1.range_image_compressed) > 0:
-                range_image_str_tensor = tf.io.decode_compressed(
-                    laser.ri_return1.range_image_compressed, 'ZLIB')
-                ri = open_dataset.MatrixFloat()
-                ri.ParseFromString(bytearray(range_image_str_tensor.numpy()))
-                self.__range_images[laser.name] = [ri]
+                self.__range_images[laser.name] = [read_matrix(self.inflater.inflate(
+                    laser.ri_return1.range_image_compressed, (laser.name, 0)))]
 
                 if laser.name == open_dataset.LaserName.TOP:
-                    range_image_top_pose_str_tensor = tf.io.decode_compressed(
-                        laser.ri_return1.range_image_pose_compressed, 'ZLIB')
-                    range_image_top_pose = open_dataset.MatrixFloat()
-                    range_image_top_pose.ParseFromString(
-                        bytearray(range_image_top_pose_str_tensor.numpy()))
+                    range_image_top_pose = read_matrix(self.inflater.inflate(
+                        laser.ri_return1.range_image_pose_compressed, 'top_pose'))
 
                 # camera_projection_str_tensor = tf.io.decode_compressed(
                 #     laser.ri_return1.camera_projection_compressed, 'ZLIB')
@@ -518,11 +1384,8 @@ class Adapter:
                 # cp.ParseFromString(bytearray(camera_projection_str_tensor.numpy()))
                 # camera_projections[laser.name] = [cp]
             if len(laser.ri_return2.range_image_compressed) > 0:
-                range_image_str_tensor = tf.io.decode_compressed(
-                    laser.ri_return2.range_image_compressed, 'ZLIB')
-                ri = open_dataset.MatrixFloat()
-                ri.ParseFromString(bytearray(range_image_str_tensor.numpy()))
-                self.__range_images[laser.name].append(ri)
+                self.__range_images[laser.name].append(read_matrix(self.inflater.inflate(
+                    laser.ri_return2.range_image_compressed, (laser.name, 1))))
                 #
                 # camera_projection_str_tensor = tf.io.decode_compressed(
                 #     laser.ri_return2.camera_projection_compressed, 'ZLIB')
@@ -554,12 +1417,11 @@ class Adapter:
     def show_range_image(self, range_image, layout_index_start=1):
         """Shows range image.
         Args:
-          range_image: the range image data from a given lidar of type MatrixFloat.
+          range_image: the [H, W, 4] range image data from a given lidar.
           layout_index_start: layout offset
         """
-        range_image_tensor = tf.convert_to_tensor(range_image.data)
-        range_image_tensor = tf.reshape(
-            range_image_tensor, range_image.shape.dims)
+        load_tensorflow()
+        range_image_tensor = tf.convert_to_tensor(range_image)
         lidar_image_mask = tf.greater_equal(range_image_tensor, 0)
         range_image_tensor = tf.where(lidar_image_mask, range_image_tensor,
                                       tf.ones_like(range_image_tensor) * 1e10)
@@ -573,7 +1435,8 @@ class Adapter:
         self.plot_range_image_helper(range_image_elongation.numpy(), 'elongation',
                                      [8, 1, layout_index_start + 2], vmax=1.5, cmap='gray')
 
-    def convert_range_image_to_point_cloud(self, frame, range_images, range_image_top_pose, ri_index=0):
+    def convert_range_image_to_point_cloud(self, frame, range_images, range_image_top_pose, returns=(0,),
+                                           geometries=None):
         """Convert range images to point cloud.
         Args:
           frame: open dataset frame
@@ -583,27 +1446,31 @@ class Adapter:
              [camera_projection_from_first_return,
               camera_projection_from_second_return]}.
           range_image_top_pose: range image pixel pose for top lidar.
-          ri_index: 0 for the first return, 1 for the second return.
+          returns: indices of the returns, 0 for the first return, 1 for the
+            second return, the returns of a laser are computed as one batch.
+          geometries: lidar_lib.LaserGeometry of the lasers, from the
+            calibration cache if None.
         Returns:
           points: {[N, 3]} list of 3d lidar points of length 5 (number of lidars).
           cp_points: {[N, 6]} list of camera projections of length 5
             (number of lidars).
           intensity: {[N, 1]} list of intensity of length 5 (number of lidars).
+          The lists hold the lidars of every return, return major, see
+          lidar_lib.range_images_to_point_cloud.
         """
-        calibrations = sorted(
-            frame.context.laser_calibrations, key=lambda c: c.name)
+        load_tensorflow()
+        if geometries is None:
+            geometries = self.calibration_cache.get(frame, range_images)
         # lasers = sorted(frame.lasers, key=lambda laser: laser.name)
-        points = []
+        points = [[] for _ in returns]
         # cp_points = []
-        intensity = []
-        elongation = []
+        intensity = [[] for _ in returns]
+        elongation = [[] for _ in returns]
 
         frame_pose = tf.convert_to_tensor(
             np.reshape(np.array(frame.pose.transform), [4, 4]))
         # [H, W, 6]
-        range_image_top_pose_tensor = tf.reshape(
-            tf.convert_to_tensor(range_image_top_pose.data),
-            range_image_top_pose.shape.dims)
+        range_image_top_pose_tensor = tf.convert_to_tensor(range_image_top_pose)
         # [H, W, 3, 3]
         range_image_top_pose_tensor_rotation = transform_utils.get_rotation_matrix(
             range_image_top_pose_tensor[...,
@@ -614,50 +1481,45 @@ class Adapter:
         range_image_top_pose_tensor = transform_utils.get_transform(
             range_image_top_pose_tensor_rotation,
             range_image_top_pose_tensor_translation)
-        for c in calibrations:
-            range_image = range_images[c.name][ri_index]
-            if len(c.beam_inclinations) == 0:
-                beam_inclinations = range_image_utils.compute_inclination(
-                    tf.constant([c.beam_inclination_min,
-                                 c.beam_inclination_max]),
-                    height=range_image.shape.dims[0])
-            else:
-                beam_inclinations = tf.constant(c.beam_inclinations)
-
-            beam_inclinations = tf.reverse(beam_inclinations, axis=[-1])
-            extrinsic = np.reshape(np.array(c.extrinsic.transform), [4, 4])
-
-            range_image_tensor = tf.reshape(
-                tf.convert_to_tensor(range_image.data), range_image.shape.dims)
+        num_returns = len(returns)
+        for c in geometries:
+            # [R, H, W, 4], the returns of the laser as one batch
+            range_image = np.stack([range_images[c.name][i] for i in returns])
+            # reversed once per segment by the calibration cache
+            beam_inclinations = np.tile(c.inclination, [num_returns, 1])
+            extrinsic = np.tile(c.extrinsic, [num_returns, 1, 1])
+
+            range_image_tensor = tf.convert_to_tensor(range_image)
             pixel_pose_local = None
             frame_pose_local = None
             if c.name == open_dataset.LaserName.TOP:
                 pixel_pose_local = range_image_top_pose_tensor
-                pixel_pose_local = tf.expand_dims(pixel_pose_local, axis=0)
-                frame_pose_local = tf.expand_dims(frame_pose, axis=0)
-            range_image_mask = range_image_tensor[..., 0] > 0
+                pixel_pose_local = tf.tile(tf.expand_dims(pixel_pose_local, axis=0),
+                                           [num_returns, 1, 1, 1, 1])
+                frame_pose_local = tf.tile(tf.expand_dims(frame_pose, axis=0),
+                                           [num_returns, 1, 1])
             range_image_cartesian = range_image_utils.extract_point_cloud_from_range_image(
-                tf.expand_dims(range_image_tensor[..., 0], axis=0),
-                tf.expand_dims(extrinsic, axis=0),
-                tf.expand_dims(tf.convert_to_tensor(
-                    beam_inclinations), axis=0),
+                range_image_tensor[..., 0],
+                tf.convert_to_tensor(extrinsic),
+                tf.convert_to_tensor(beam_inclinations),
                 pixel_pose=pixel_pose_local,
                 frame_pose=frame_pose_local)
 
-            range_image_cartesian = tf.squeeze(range_image_cartesian, axis=0)
-            points_tensor = tf.gather_nd(range_image_cartesian,
-                                         tf.where(range_image_mask))
-            intensity_tensor = tf.gather_nd(range_image_tensor,
-                                            tf.where(range_image_mask))
-            # cp = camera_projections[c.name][0]
-            # cp_tensor = tf.reshape(tf.convert_to_tensor(cp.data), cp.shape.dims)
-            # cp_points_tensor = tf.gather_nd(cp_tensor, tf.where(range_image_mask))
-            points.append(points_tensor.numpy())
-            # cp_points.append(cp_points_tensor.numpy())
-            intensity.append(intensity_tensor.numpy()[:, 1])
-            elongation.append(intensity_tensor.numpy()[:, 2])
-
-        return points, intensity, elongation
+            for r in range(num_returns):
+                range_image_mask = range_image_tensor[r, ..., 0] > 0
+                points_tensor = tf.gather_nd(range_image_cartesian[r],
+                                             tf.where(range_image_mask))
+                intensity_tensor = tf.gather_nd(range_image_tensor[r],
+                                                tf.where(range_image_mask))
+                # cp = camera_projections[c.name][0]
+                # cp_tensor = tf.reshape(tf.convert_to_tensor(cp.data), cp.shape.dims)
+                # cp_points_tensor = tf.gather_nd(cp_tensor, tf.where(range_image_mask))
+                points[r].append(points_tensor.numpy())
+                # cp_points.append(cp_points_tensor.numpy())
+                intensity[r].append(intensity_tensor.numpy()[:, 1])
+                elongation[r].append(intensity_tensor.numpy()[:, 2])
+
+        return sum(points, []), sum(intensity, []), sum(elongation, [])
 
     def rgba(self, r):
         """Generates a color based on range.
@@ -673,6 +1535,7 @@ class Adapter:
 
     def plot_image(self, camera_image):
         """Plot a cmaera image."""
+        load_tensorflow()
         plt.figure(figsize=(20, 12))
         plt.imshow(tf.image.decode_jpeg(camera_image.image))
         plt.grid("off")
@@ -700,6 +1563,246 @@ class Adapter:
         plt.scatter(xs, ys, c=colors, s=point_size, edgecolors="none")
 
 
+class DecodedFrame:
+    """ a frame with its lidar decoded on first use
+    The range images, the point cloud and the labels are computed once and
+    shared by the label check and every save_* method of the frame.
+    """
+
+    def __init__(self, adapter, frame, range_images=None, range_image_top_pose=None):
+        """
+                :param adapter: Adapter decoding the frame
+                :param frame: open dataset frame proto
+                :param range_images: already decoded range images, see
+                    Adapter.parse_range_image_and_camera_projection
+        """
+        self.adapter = adapter
+        self.frame = frame
+        self._range_images = range_images
+        self._range_image_top_pose = range_image_top_pose
+        self._point_cloud = None
+        self._labels = {}
+
+    @property
+    def range_images(self):
+        """ (range_images, range_image_top_pose) of the frame """
+        if self._range_images is None:
+            self._range_images, self._range_image_top_pose = \
+                self.adapter.parse_range_image_and_camera_projection(self.frame)
+        return self._range_images, self._range_image_top_pose
+
+    @property
+    def point_cloud(self):
+        """ [N, 5] point cloud of the frame, see Adapter.get_point_cloud """
+        if self._point_cloud is None:
+            range_images, range_image_top_pose = self.range_images
+            self._point_cloud = self.adapter.get_point_cloud(
+                self.frame, range_images, range_image_top_pose)
+        return self._point_cloud
+
+    def labels(self, cam_type):
+        """ label_content of the frame for a camera, None if the camera sees no
+        object
+        """
+        if cam_type not in self._labels:
+            range_images, range_image_top_pose = self.range_images
+            self._labels[cam_type] = self.adapter.label_content(
+                self.frame, cam_type, point_cloud=self.point_cloud,
+                range_images=range_images, range_image_top_pose=range_image_top_pose)
+        return self._labels[cam_type]
+
+
+class PipelineWorker:
+    """ state of one process of Adapter.pipeline_results
+    A frame travels as ('frame', job index, frame_name, data), data holding the
+    ring handles and text outputs added by the stages, or None once the frame
+    is dropped. The read stage ends every segment with ('segment', job, number
+    of frames read), the other stages pass it on.
+    """
+
+    def __init__(self, args, rings):
+        set_thread_budget(args.cores_per_worker)
+        self.adapter = Adapter(args.lidar_engine, args.validate_lidar, args.lidar_returns,
+                               calibration_segments(args))
+        self.args = args
+        self.rings = rings
+
+    def read(self, job, emit):
+        """ read stage: load the keyframe records of a segment """
+        frame_name = job.frame_name
+        records = iter_records(job.file_name, self.args.read_buffer_mb << 20,
+                               self.args.check_crc, self.args.mmap, self.args.compression)
+        for record_num, data in enumerate(records):
+            # excluded segments are never scheduled, so every keyframe is kept
+            if (job.frame_num + record_num) % self.args.keyframe != 0:
+                continue
+            handle = self.rings['record'].put(
+                {'record': np.frombuffer(data, np.uint8)})
+            emit(('frame', job.index, frame_name, {'record': handle}))
+            frame_name += 1
+        emit(('segment', job, frame_name - job.frame_name))
+
+    def decode(self, item, emit):
+        """ decode stage: parse the frame, decompress its range images and
+        decode its image
+        """
+        if item[0] != 'frame':
+            emit(item)
+            return
+        data = item[3]
+        handle = data.pop('record')
+        frame = self.adapter.parse_frame(
+            self.rings['record'].get(handle)['record'], self.args.camera_type)
+        self.rings['record'].release(handle)
+
+        range_images, range_image_top_pose = \
+            self.adapter.parse_range_image_and_camera_projection(frame)
+        arrays = {'top_pose': range_image_top_pose}
+        for laser_name, returns in range_images.items():
+            for ri_index, range_image in enumerate(returns):
+                arrays[(laser_name, ri_index)] = range_image
+        rgb_img = self.adapter.decode_image(frame, self.args.camera_type)
+        if rgb_img is not None:
+            arrays['image'] = rgb_img
+        data['decoded'] = self.rings['decoded'].put(arrays)
+
+        # the next stages only need the small fields of the frame
+        frame.ClearField('lasers')
+        for img in frame.images:
+            img.ClearField('image')
+        data['frame'] = frame.SerializeToString()
+        emit(item)
+
+    def compute(self, item, emit):
+        """ compute stage: point cloud, labels and the other text files """
+        if item[0] != 'frame':
+            emit(item)
+            return
+        _, index, frame_name, data = item
+        frame = open_dataset.Frame()
+        frame.ParseFromString(data.pop('frame'))
+        arrays = self.rings['decoded'].get(data['decoded'])
+        range_images = {}
+        for key, array in arrays.items():
+            if isinstance(key, tuple):
+                range_images.setdefault(key[0], []).append(array)
+        decoded = DecodedFrame(self.adapter, frame, range_images, arrays['top_pose'])
+        point_cloud = decoded.point_cloud
+        del arrays, range_images
+
+        if self.args.test == False:
+            if decoded.labels(self.args.camera_type) is None:
+                self.rings['decoded'].release(data['decoded'])
+                emit(('frame', index, frame_name, None))
+                return
+        data['texts'] = self.adapter.text_outputs(self.args, decoded, frame_name)
+        data['lidar'] = self.rings['lidar'].put({'lidar': point_cloud})
+        emit(item)
+
+    def encode(self, item, emit):
+        """ encode stage: compress the image """
+        if item[0] != 'frame' or item[3] is None:
+            emit(item)
+            return
+        data = item[3]
+        handle = data.pop('decoded')
+        arrays = self.rings['decoded'].get(handle)
+        if 'image' in arrays:
+            encoded = self.adapter.encode_image(arrays['image'])
+            data['image'] = self.rings['image'].put(
+                {'image': np.frombuffer(encoded, np.uint8)})
+        del arrays
+        self.rings['decoded'].release(handle)
+        emit(item)
+
+    def write(self, item, emit):
+        """ write stage: save the files of a frame and free its slots """
+        if item[0] != 'frame':
+            emit(item)
+            return
+        _, index, frame_name, data = item
+        if data is None:
+            emit(('frame', index, False))
+            return
+        for path, content in data['texts'].items():
+            with open(path, 'w+') as f:
+                f.write(content)
+        if 'image' in data:
+            arrays = self.rings['image'].get(data['image'])
+            self.adapter.write_encoded_image(arrays['image'], frame_name)
+            del arrays
+            self.rings['image'].release(data['image'])
+        arrays = self.rings['lidar'].get(data['lidar'])
+        self.adapter.write_lidar(arrays['lidar'], frame_name)
+        del arrays
+        self.rings['lidar'].release(data['lidar'])
+        emit(('frame', index, True))
+
+
+def load_tensorflow():
+    """ import TensorFlow and the waymo utils on first use, with the thread
+    budget of the process
+            :return: the tensorflow module
+    """
+    global tf, range_image_utils, transform_utils, test_utils, box_utils
+    if tf is None:
+        import tensorflow
+        from waymo_open_dataset.utils import range_image_utils
+        from waymo_open_dataset.utils import transform_utils
+        from waymo_open_dataset.utils import test_utils
+        from waymo_open_dataset.utils import box_utils
+        tf = tensorflow
+        if thread_budget is not None:
+            set_tensorflow_threads(thread_budget)
+    return tf
+
+
+def set_tensorflow_threads(num_threads):
+    _, _, intra_op, inter_op = thread_layout(num_threads, 1)
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op)
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op)
+
+
+def set_thread_budget(num_threads):
+    """ limit TensorFlow and OpenCV of this process to num_threads threads,
+    TensorFlow is limited when load_tensorflow imports it, or now if it is
+    already loaded, before its first op
+    """
+    global thread_budget
+    if num_threads is None:
+        return
+    thread_budget = num_threads
+    if tf is not None:
+        set_tensorflow_threads(num_threads)
+    cv2.setNumThreads(num_threads)
+
+
+def calibration_segments(args):
+    """ number of segments whose frames a process converts at once, the size
+    of its CalibrationCache
+    """
+    if args.pipeline:
+        # every reader can be one segment ahead of the compute stage
+        return max(4, 2 * args.stage_workers[0])
+    return max(4, args.interleave)
+
+
+def convert_segment_job(job_args):
+    """ worker entry point of Adapter.cvt_parallel
+            :param job_args: (args, SegmentJob)
+            :return: the job, the number of frames it saved and a dict of the
+                conversion and write times
+    """
+    args, job = job_args
+    adapter = Adapter(args.lidar_engine, args.validate_lidar, args.lidar_returns,
+                      calibration_segments(args))
+    start_time = time.time()
+    _, frame_name = adapter.convert_segment(
+        args, job.file_name, job.frame_num, job.frame_name)
+    stats = {'seconds': time.time() - start_time,
+             'write_seconds': adapter.write_seconds}
+    return job, frame_name - job.frame_name, stats
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Save Waymo dataset into Kitti format')
@@ -719,12 +1822,179 @@ if __name__ == '__main__':
                         type=bool,
                         default=False,
                         help='if true, does not save any ground truth data')
+    parser.add_argument('--workers',
+                        type=int,
+                        default=None,
+                        help='Number of processes converting segments in parallel. Default is 1, '
+                             'or all available cores divided by --cores_per_worker')
+    parser.add_argument('--cores_per_worker',
+                        type=int,
+                        default=None,
+                        help='Threads given to TensorFlow and OpenCV in every worker. '
+                             'Default is no limit')
+    parser.add_argument('--frames',
+                        type=str,
+                        default=None,
+                        help='Text file of the frames to convert instead of whole segments, one '
+                             '"<segment file> <frame index>" or "<context name> <timestamp_micros>" '
+                             'per line')
+    parser.add_argument('--dry_run', '--dry-run',
+                        action='store_true',
+                        help='Print the frames, disk usage and time of the conversion without '
+                             'converting anything')
+    parser.add_argument('--lidar_engine',
+                        type=str,
+                        choices=['tf', 'tf_graph', 'numpy'],
+                        default='tf',
+                        help='Compute the point clouds and the points in the label boxes with '
+                             'TensorFlow, with the point clouds in a compiled TensorFlow graph, '
+                             'or with NumPy, NumPy workers never load TensorFlow')
+    parser.add_argument('--validate_lidar',
+                        action='store_true',
+                        help='Compute every point cloud with both engines and stop if they differ')
+    parser.add_argument('--lidar_returns',
+                        type=str,
+                        choices=['first', 'second', 'both'],
+                        default='first',
+                        help='Range image returns saved in the point clouds, both adds the return '
+                             'index as a sixth value of every point')
+    parser.add_argument('--verify',
+                        action='store_true',
+                        help='Check the output files of the segments listed in the manifest '
+                             'and convert the ones that do not match again')
+    parser.add_argument('--restart',
+                        action='store_true',
+                        help='Ignore the manifest and convert every segment')
+    parser.add_argument('--watch',
+                        action='store_true',
+                        help='Keep running and convert new .tfrecord files as they arrive')
+    parser.add_argument('--inbox',
+                        type=str,
+                        default=None,
+                        help='Folder watched by --watch. Default is RAW_DATA_PATH')
+    parser.add_argument('--poll_interval',
+                        type=float,
+                        default=60,
+                        help='Seconds between two scans of the --watch folder')
+    parser.add_argument('--read_buffer_mb',
+                        type=int,
+                        default=8,
+                        help='Read buffer of every .tfrecord file in MB')
+    parser.add_argument('--prefetch',
+                        type=int,
+                        default=4,
+                        help='Number of records read ahead while a frame is converted')
+    parser.add_argument('--mmap',
+                        action='store_true',
+                        help='Map the .tfrecord files in memory instead of reading them')
+    parser.add_argument('--check_crc',
+                        action='store_true',
+                        help='Check the CRC of every record read, faster with the crc32c package')
+    parser.add_argument('--compression',
+                        type=str,
+                        choices=['auto', 'none', 'gzip', 'zlib'],
+                        default='auto',
+                        help='Compression of the .tfrecord files, detected from each file by default')
+    parser.add_argument('--interleave',
+                        type=int,
+                        default=1,
+                        help='Number of .tfrecord files read in parallel by a single process')
+    parser.add_argument('--autoscale',
+                        action='store_true',
+                        help='Tune the number of segments converted at once between segments to '
+                             'the best frames per second, up to --workers')
+    parser.add_argument('--pipeline',
+                        action='store_true',
+                        help='Split the conversion into read, decode, compute, encode and write '
+                             'stages running in their own processes')
+    parser.add_argument('--stage_workers',
+                        type=str,
+                        default=None,
+                        help='Processes of each --pipeline stage as "read,decode,compute,encode,write". '
+                             'Default is 1 reader, --workers processes for the middle stages '
+                             'and --write_workers writers')
+    parser.add_argument('--write_workers',
+                        type=int,
+                        default=1,
+                        help='Number of write processes of --pipeline')
+    parser.add_argument('--ring_slots',
+                        type=int,
+                        default=None,
+                        help='Number of shared memory frames between two --pipeline stages. '
+                             'Default is twice the processes of the two widest adjacent stages')
+    parser.add_argument('--queue_size',
+                        type=int,
+                        default=None,
+                        help='Maximum number of frames waiting between two --pipeline stages. '
+                             'Default is --ring_slots')
+    parser.add_argument('--slot_mb',
+                        type=int,
+                        default=None,
+                        help='Size in MB of a shared memory frame of every --pipeline ring. By '
+                             'default each ring is sized from its own payload')
+    parser.add_argument('--num_shards',
+                        type=int,
+                        default=1,
+                        help='Split the segments into this many shards, e.g. one per machine')
+    parser.add_argument('--shard_id',
+                        type=int,
+                        default=0,
+                        help='Shard converted by this process, from 0 to num_shards - 1')
     args = parser.parse_args()
+    if not 0 <= args.shard_id < args.num_shards:
+        parser.error('--shard_id must be in [0, --num_shards)')
+    if args.autoscale and args.pipeline:
+        parser.error('--autoscale does not support --pipeline')
+    if args.watch and args.num_shards > 1:
+        parser.error('--watch does not support --num_shards')
+    if args.dry_run and args.watch:
+        parser.error('--dry_run does not support --watch')
+    if args.frames is not None and (args.watch or args.num_shards > 1):
+        parser.error('--frames does not support --watch or --num_shards')
+    args.compression = {'auto': None, 'none': '', 'gzip': 'GZIP', 'zlib': 'ZLIB'}[args.compression]
+    if args.frames is not None and args.compression not in [None, '']:
+        parser.error('--frames needs uncompressed .tfrecord files')
+    if args.cores_per_worker is not None:
+        if args.cores_per_worker < 1:
+            parser.error('--cores_per_worker must be at least 1')
+        cores, args.workers, intra_op, inter_op = thread_layout(
+            args.cores_per_worker, args.workers)
+        # picked up by the BLAS of the spawned workers
+        os.environ['OMP_NUM_THREADS'] = str(args.cores_per_worker)
+        print('Thread budget: {} cores, {} workers x {} threads '
+              '(TensorFlow intra-op {}, inter-op {}, OpenCV {})'.format(
+                  cores, args.workers, args.cores_per_worker,
+                  intra_op, inter_op, args.cores_per_worker))
+        if args.workers * args.cores_per_worker > cores:
+            print('Warning: {} threads requested on {} cores'.format(
+                args.workers * args.cores_per_worker, cores))
+        if args.workers == 1:
+            set_thread_budget(args.cores_per_worker)
+    elif args.workers is None:
+        args.workers = 1
+    if args.autoscale and args.workers < 2:
+        parser.error('--autoscale needs --workers 2 or more, the most segments converted at once')
+    if args.stage_workers is None:
+        args.stage_workers = [1, args.workers, args.workers,
+                              args.workers, args.write_workers]
+    else:
+        args.stage_workers = [int(n) for n in args.stage_workers.split(',')]
+        if len(args.stage_workers) != 5 or min(args.stage_workers) < 1:
+            parser.error('--stage_workers needs 5 positive numbers')
+    if args.ring_slots is None:
+        # a ring is filled by one stage and emptied by the next ones
+        args.ring_slots = 2 * max(a + b for a, b in zip(args.stage_workers, args.stage_workers[1:]))
+    if args.queue_size is None:
+        args.queue_size = args.ring_slots
     start_ind = args.start_ind
+    if args.watch:
+        Adapter(args.lidar_engine, args.validate_lidar, args.lidar_returns,
+                calibration_segments(args)).watch(args, start_ind)
     with open(IMAGESET_PATH, 'r') as f:
         data_records = f.read().splitlines()
     # path, dirs, files = next(os.walk(DATA_PATH))
-    adapter = Adapter()
+    adapter = Adapter(args.lidar_engine, args.validate_lidar, args.lidar_returns,
+                      calibration_segments(args))
     last_ind = adapter.cvt(args, data_records, start_ind)
     # dirs.sort()
     # for directory in dirs:
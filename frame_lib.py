@@ -0,0 +1,323 @@
+import ctypes
+import ctypes.util
+import zlib
+
+import numpy as np
+
+# field numbers of the open dataset protos read without parsing the frame,
+# see protocol_buffer/dataset_pb2.py
+FRAME_CONTEXT = 1
+FRAME_TIMESTAMP_MICROS = 2
+FRAME_IMAGES = 4
+FRAME_LASERS = 5
+FRAME_NO_LABEL_ZONES = 7
+CONTEXT_NAME = 1
+CONTEXT_STATS = 4
+STATS_LASER_OBJECT_COUNTS = 1
+STATS_TIME_OF_DAY = 2
+STATS_LOCATION = 3
+STATS_WEATHER = 4
+STATS_CAMERA_OBJECT_COUNTS = 5
+OBJECT_COUNT_TYPE = 1
+OBJECT_COUNT_COUNT = 2
+CAMERA_IMAGE_NAME = 1
+CAMERA_IMAGE_IMAGE = 2
+LASER_RI_RETURN1 = 2
+LASER_RI_RETURN2 = 3
+RANGE_IMAGE_CAMERA_PROJECTION = 3
+MATRIX_DATA = 1
+MATRIX_SHAPE = 2
+SHAPE_DIMS = 1
+
+# protobuf wire types
+VARINT = 0
+FIXED64 = 1
+LENGTH_DELIMITED = 2
+FIXED32 = 5
+
+# zlib of the system, decompressing into buffers we own, the zlib module is
+# used where it cannot be loaded
+Z_OK = 0
+Z_BUF_ERROR = -5
+_libz_name = ctypes.util.find_library('z')
+try:
+    _libz = ctypes.CDLL(_libz_name) if _libz_name is not None else None
+    if _libz is not None:
+        _libz.uncompress.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulong),
+                                     ctypes.c_char_p, ctypes.c_ulong]
+        _libz.uncompress.restype = ctypes.c_int
+except (OSError, AttributeError):
+    _libz = None
+
+
+def read_varint(data, pos):
+    """ decode the varint of data at pos
+        :return: (value, position after the varint)
+    """
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError('truncated varint')
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def iter_fields(data, start=0, end=None):
+    """ iterate over the fields of a serialized message without decoding it
+        :param data: bytes or memoryview of the message
+        :param start, end: range of data holding the message
+        :return: iterator of (field number, wire type, field start, start,
+            end), field start being the position of the key and start and end
+            delimiting the value, for a length delimited field its content
+    """
+    if end is None:
+        end = len(data)
+    pos = start
+    while pos < end:
+        field_start = pos
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 7
+        if wire_type == VARINT:
+            _, value_end = read_varint(data, pos)
+        elif wire_type == FIXED64:
+            value_end = pos + 8
+        elif wire_type == LENGTH_DELIMITED:
+            length, pos = read_varint(data, pos)
+            value_end = pos + length
+        elif wire_type == FIXED32:
+            value_end = pos + 4
+        else:
+            raise ValueError('unsupported wire type {}'.format(wire_type))
+        if value_end > end:
+            raise ValueError('truncated field {}'.format(field))
+        yield field, wire_type, field_start, pos, value_end
+        pos = value_end
+
+
+def find_field(data, field, start=0, end=None):
+    """ (start, end) of the first length delimited field of a message with
+    the given number, None if it is not set
+    """
+    for number, wire_type, _, value_start, value_end in iter_fields(data, start, end):
+        if number == field and wire_type == LENGTH_DELIMITED:
+            return value_start, value_end
+    return None
+
+
+def read_location(data):
+    """ context.stats.location of a serialized Frame, only the context is
+    scanned, '' if it is not set like the proto default
+    """
+    data = memoryview(data)
+    span = (0, len(data))
+    for field in [FRAME_CONTEXT, CONTEXT_STATS, STATS_LOCATION]:
+        span = find_field(data, field, *span)
+        if span is None:
+            return ''
+    return bytes(data[span[0]:span[1]]).decode('utf-8')
+
+
+def read_frame_key(data):
+    """ (context.name, timestamp_micros) of a serialized Frame, the fields
+    after them are not scanned, so data may be the start of the frame only
+    (the context and timestamp come first in a serialized Frame)
+    """
+    data = memoryview(data)
+    name = None
+    timestamp = None
+    for field, wire_type, _, start, end in iter_fields(data):
+        if field == FRAME_CONTEXT and wire_type == LENGTH_DELIMITED:
+            span = find_field(data, CONTEXT_NAME, start, end)
+            name = '' if span is None else bytes(data[span[0]:span[1]]).decode('utf-8')
+        elif field == FRAME_TIMESTAMP_MICROS and wire_type == VARINT:
+            timestamp, _ = read_varint(data, start)
+        if name is not None and timestamp is not None:
+            return name, timestamp
+    raise ValueError('no context name or timestamp in the frame')
+
+
+def read_stats(data):
+    """ context.stats of a serialized Frame, only the context is scanned
+        :return: dict of location, time_of_day and weather strings and of
+            laser_object_counts and camera_object_counts, dicts of
+            {label type: number of objects}
+    """
+    data = memoryview(data)
+    stats = {'location': '', 'time_of_day': '', 'weather': '',
+             'laser_object_counts': {}, 'camera_object_counts': {}}
+    span = find_field(data, FRAME_CONTEXT)
+    if span is not None:
+        span = find_field(data, CONTEXT_STATS, *span)
+    if span is None:
+        return stats
+    strings = {STATS_LOCATION: 'location', STATS_TIME_OF_DAY: 'time_of_day',
+               STATS_WEATHER: 'weather'}
+    counts = {STATS_LASER_OBJECT_COUNTS: 'laser_object_counts',
+              STATS_CAMERA_OBJECT_COUNTS: 'camera_object_counts'}
+    for field, wire_type, _, start, end in iter_fields(data, *span):
+        if wire_type != LENGTH_DELIMITED:
+            continue
+        if field in strings:
+            stats[strings[field]] = bytes(data[start:end]).decode('utf-8')
+        elif field in counts:
+            values = {OBJECT_COUNT_TYPE: 0, OBJECT_COUNT_COUNT: 0}
+            for number, number_type, _, value_start, _ in iter_fields(data, start, end):
+                if number in values and number_type == VARINT:
+                    values[number] = read_varint(data, value_start)[0]
+            object_counts = stats[counts[field]]
+            object_type = values[OBJECT_COUNT_TYPE]
+            object_counts[object_type] = object_counts.get(object_type, 0) + \
+                values[OBJECT_COUNT_COUNT]
+    return stats
+
+
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def filter_fields(data, start, end, keep):
+    """ pieces of a serialized message with some of its fields dropped or
+    rewritten, the kept bytes are memoryview slices of data, not copies
+        :param keep: called as keep(field, wire type, start, end) for every
+            field, returns True to keep the field, False to drop it or the
+            (pieces, length) of a new content for a length delimited field
+        :return: (list of pieces, total length)
+    """
+    pieces = []
+    length = 0
+    # consecutive kept fields are copied as a single slice
+    run_start = start
+    for field, wire_type, field_start, value_start, value_end in \
+            iter_fields(data, start, end):
+        kept = keep(field, wire_type, value_start, value_end)
+        if kept is True:
+            continue
+        if run_start < field_start:
+            pieces.append(data[run_start:field_start])
+            length += field_start - run_start
+        run_start = value_end
+        if kept is not False:
+            content, content_length = kept
+            header = encode_varint(field << 3 | LENGTH_DELIMITED) + \
+                encode_varint(content_length)
+            pieces.append(header)
+            pieces.extend(content)
+            length += len(header) + content_length
+    if run_start < end:
+        pieces.append(data[run_start:end])
+        length += end - run_start
+    return pieces, length
+
+
+def select_frame(data, cameras=None, second_returns=True):
+    """ serialized Frame reduced to the fields the conversion reads
+    The JPEG of the cameras not in cameras, the camera projections of the
+    range images and the no label zones are skipped without being copied,
+    every other field is kept as it is.
+        :param data: bytes or buffer of a serialized Frame
+        :param cameras: names (CameraName) of the cameras whose image is
+            kept, None to keep all of them
+        :param second_returns: False to also skip the second return range
+            images of the lasers
+        :return: bytes of the reduced Frame, to be parsed with ParseFromString
+    """
+    data = memoryview(data)
+
+    def keep_range_image(field, wire_type, start, end):
+        return field != RANGE_IMAGE_CAMERA_PROJECTION
+
+    def keep_laser(field, wire_type, start, end):
+        if field == LASER_RI_RETURN2 and not second_returns:
+            return False
+        if field in (LASER_RI_RETURN1, LASER_RI_RETURN2) and wire_type == LENGTH_DELIMITED:
+            return filter_fields(data, start, end, keep_range_image)
+        return True
+
+    def keep_frame(field, wire_type, start, end):
+        if wire_type != LENGTH_DELIMITED:
+            return True
+        if field == FRAME_NO_LABEL_ZONES:
+            return False
+        if field == FRAME_LASERS:
+            return filter_fields(data, start, end, keep_laser)
+        if field == FRAME_IMAGES and cameras is not None:
+            name = 0
+            for number, number_type, _, value_start, _ in iter_fields(data, start, end):
+                if number == CAMERA_IMAGE_NAME and number_type == VARINT:
+                    name, _ = read_varint(data, value_start)
+            if name not in cameras:
+                return filter_fields(data, start, end,
+                                     lambda number, *_: number != CAMERA_IMAGE_IMAGE)
+        return True
+
+    pieces, _ = filter_fields(data, 0, len(data), keep_frame)
+    return b''.join(pieces)
+
+
+class Inflater:
+    """ zlib decompression into output buffers reused from one call to the
+    next, one buffer per key, e.g. per laser and return
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def inflate(self, data, key):
+        """ decompress zlib data
+            :param data: bytes of the compressed data
+            :param key: buffer to decompress into, it grows as needed
+            :return: memoryview of the decompressed data, it is only valid
+                until the next call with the same key
+        """
+        if _libz is None:
+            return memoryview(zlib.decompress(data))
+        buffer = self.buffers.get(key)
+        if buffer is None:
+            buffer = np.empty(max(8 * len(data), 1 << 16), np.uint8)
+        while True:
+            size = ctypes.c_ulong(buffer.nbytes)
+            status = _libz.uncompress(buffer.ctypes.data, ctypes.byref(size), data, len(data))
+            if status == Z_OK:
+                break
+            if status != Z_BUF_ERROR:
+                raise zlib.error('uncompress failed with error {}'.format(status))
+            buffer = np.empty(2 * buffer.nbytes, np.uint8)
+        self.buffers[key] = buffer
+        return memoryview(buffer)[:size.value]
+
+
+def read_matrix(data, dtype='<f4'):
+    """ numpy view of the data of a serialized MatrixFloat (or MatrixInt32
+    with dtype '<i4'), shaped by its dims, nothing is copied
+    """
+    data = memoryview(data)
+    values = np.zeros(0, dtype)
+    dims = []
+    for field, wire_type, _, start, end in iter_fields(data):
+        if field == MATRIX_DATA and wire_type == LENGTH_DELIMITED:
+            # data is a packed field
+            values = np.frombuffer(data[start:end], dtype)
+        elif field == MATRIX_SHAPE and wire_type == LENGTH_DELIMITED:
+            for number, dims_type, _, dims_start, dims_end in iter_fields(data, start, end):
+                if number != SHAPE_DIMS:
+                    continue
+                if dims_type == VARINT:
+                    dims.append(read_varint(data, dims_start)[0])
+                elif dims_type == LENGTH_DELIMITED:
+                    pos = dims_start
+                    while pos < dims_end:
+                        dim, pos = read_varint(data, pos)
+                        dims.append(dim)
+        elif field == MATRIX_DATA:
+            raise ValueError('unpacked matrix data')
+    return values.reshape(dims)
@@ -0,0 +1,240 @@
+import collections
+
+import numpy as np
+
+# LaserName.TOP, the only laser with a per pixel pose
+LASER_TOP = 1
+# maximum difference in meters between the points of the numpy and the
+# TensorFlow engines accepted by --validate_lidar
+VALIDATE_ATOL = 1e-3
+# range image returns of every --lidar_returns choice
+LIDAR_RETURNS = {'first': (0,), 'second': (1,), 'both': (0, 1)}
+
+# constant geometry of a laser over a segment
+#   name: LaserName of the laser
+#   extrinsic: [4, 4] float64 laser to vehicle transform
+#   inclination: [H] float32 inclination of every row, from the top row
+#   directions: [H, W, 3] float32 unit vector of every pixel, rotated to the
+#       vehicle frame, a point is its range times its direction plus the
+#       translation of extrinsic
+LaserGeometry = collections.namedtuple(
+    'LaserGeometry', ['name', 'extrinsic', 'inclination', 'directions'])
+
+
+def compute_inclination(inclination_min, inclination_max, height):
+    """ uniform beam inclinations of a laser without beam_inclinations, see
+    range_image_utils.compute_inclination
+    """
+    diff = inclination_max - inclination_min
+    return (0.5 + np.arange(height, dtype=np.float32)) / height * diff + inclination_min
+
+
+def rotation_matrix(roll, pitch, yaw):
+    """ [..., 3, 3] rotations of arrays of roll, pitch and yaw angles, see
+    transform_utils.get_rotation_matrix
+    """
+    cos_roll, sin_roll = np.cos(roll), np.sin(roll)
+    cos_pitch, sin_pitch = np.cos(pitch), np.sin(pitch)
+    cos_yaw, sin_yaw = np.cos(yaw), np.sin(yaw)
+    rotation = np.empty(np.shape(roll) + (3, 3), np.result_type(roll, np.float32))
+    # yaw @ pitch @ roll, expanded
+    rotation[..., 0, 0] = cos_yaw * cos_pitch
+    rotation[..., 0, 1] = cos_yaw * sin_pitch * sin_roll - sin_yaw * cos_roll
+    rotation[..., 0, 2] = cos_yaw * sin_pitch * cos_roll + sin_yaw * sin_roll
+    rotation[..., 1, 0] = sin_yaw * cos_pitch
+    rotation[..., 1, 1] = sin_yaw * sin_pitch * sin_roll + cos_yaw * cos_roll
+    rotation[..., 1, 2] = sin_yaw * sin_pitch * cos_roll - cos_yaw * sin_roll
+    rotation[..., 2, 0] = -sin_pitch
+    rotation[..., 2, 1] = cos_pitch * sin_roll
+    rotation[..., 2, 2] = cos_pitch * cos_roll
+    return rotation
+
+
+def laser_geometry(calibration, height, width):
+    """ LaserGeometry of a laser calibration proto for range images of
+    height x width pixels, see
+    range_image_utils.extract_point_cloud_from_range_image
+    """
+    if len(calibration.beam_inclinations) == 0:
+        inclination = compute_inclination(
+            calibration.beam_inclination_min, calibration.beam_inclination_max, height)
+    else:
+        inclination = np.array(calibration.beam_inclinations, np.float32)
+    # the first row of a range image is the highest beam
+    inclination = inclination[::-1].copy()
+    extrinsic = np.reshape(np.array(calibration.extrinsic.transform), [4, 4])
+
+    az_correction = np.arctan2(extrinsic[1, 0], extrinsic[0, 0])
+    ratios = (np.arange(width, 0, -1) - 0.5) / width
+    azimuth = (ratios * 2. - 1.) * np.pi - az_correction
+    cos_inclination = np.cos(inclination)[:, np.newaxis]
+    directions = np.empty((height, width, 3))
+    directions[..., 0] = np.cos(azimuth) * cos_inclination
+    directions[..., 1] = np.sin(azimuth) * cos_inclination
+    directions[..., 2] = np.sin(inclination)[:, np.newaxis]
+    directions = directions @ extrinsic[:3, :3].T
+    return LaserGeometry(calibration.name, extrinsic, inclination,
+                         directions.astype(np.float32))
+
+
+class CalibrationCache:
+    """ LaserGeometry of the lasers of the last segments, keyed by
+    context.name, they are computed once for the ~200 frames of a segment
+    """
+
+    def __init__(self, max_segments=4):
+        self.max_segments = max_segments
+        self.segments = collections.OrderedDict()
+
+    def get(self, frame, range_images):
+        """ LaserGeometry of every laser of a frame, sorted by laser name
+            :param frame: open dataset frame proto
+            :param range_images: {laser name: [range images of every return]}
+        """
+        shapes = tuple(sorted((name, images[0].shape[:2])
+                              for name, images in range_images.items()))
+        key = (frame.context.name, shapes)
+        if key in self.segments:
+            self.segments.move_to_end(key)
+            return self.segments[key]
+        calibrations = sorted(frame.context.laser_calibrations, key=lambda c: c.name)
+        geometries = [laser_geometry(c, *range_images[c.name][0].shape[:2])
+                      for c in calibrations]
+        self.segments[key] = geometries
+        if len(self.segments) > self.max_segments:
+            self.segments.popitem(last=False)
+        return geometries
+
+
+def range_image_to_points(range_image, geometry, pixel_pose=None, frame_pose=None):
+    """ points of the valid pixels of a range image, in the vehicle frame, see
+    range_image_utils.extract_point_cloud_from_range_image
+    Only the pixels with a positive range are computed, in row major order
+    like tf.where.
+        :param range_image: [H, W, C] range image, range in channel 0, or
+            [R, H, W, C] range images of several returns, stacked
+        :param geometry: LaserGeometry of the laser
+        :param pixel_pose: [H, W, 6] roll, pitch, yaw, x, y, z of the vehicle
+            for every pixel, the top laser only
+        :param frame_pose: [4, 4] vehicle to world transform of the frame,
+            needed with pixel_pose
+        :return: ([N, 3] float32 points, [N, C] values of the valid pixels)
+    """
+    index = np.nonzero(range_image[..., 0] > 0)
+    rows, cols = index[-2:]
+    values = range_image[index]
+    points = geometry.directions[rows, cols] * values[:, 0:1] + \
+        geometry.extrinsic[:3, 3].astype(np.float32)
+
+    if pixel_pose is not None:
+        pose = np.asarray(pixel_pose, np.float32)[rows, cols]
+        rotation = rotation_matrix(pose[:, 0], pose[:, 1], pose[:, 2])
+        points = np.einsum('nij,nj->ni', rotation, points) + pose[:, 3:]
+        world_to_vehicle = np.linalg.inv(np.asarray(frame_pose, np.float64)).astype(np.float32)
+        points = points @ world_to_vehicle[:3, :3].T + world_to_vehicle[:3, 3]
+    return points, values
+
+
+def range_images_to_point_cloud(geometries, range_images, range_image_top_pose,
+                                frame_pose, returns=(0,)):
+    """ points of every laser of a frame, see
+    Adapter.convert_range_image_to_point_cloud
+    The returns of a laser are stacked and computed in a single pass.
+        :param geometries: LaserGeometry of the lasers of the frame, in the
+            order of the output, see CalibrationCache
+        :param range_images: {laser name: [range images of every return]}
+        :param range_image_top_pose: [H, W, 6] pose of the top laser pixels
+        :param frame_pose: [4, 4] vehicle to world transform of the frame
+        :param returns: indices of the returns, 0 for the first return, 1
+            for the second return
+        :return: lists of points, intensity and elongation of every return
+            and every laser, return major: the lasers of the first return
+            in returns, then the lasers of the next one
+    """
+    points = [[] for _ in returns]
+    intensity = [[] for _ in returns]
+    elongation = [[] for _ in returns]
+    for geometry in geometries:
+        range_image = np.stack([range_images[geometry.name][i] for i in returns])
+        if geometry.name == LASER_TOP:
+            laser_points, values = range_image_to_points(
+                range_image, geometry, range_image_top_pose, frame_pose)
+        else:
+            laser_points, values = range_image_to_points(range_image, geometry)
+        # the points are sorted by return, split them
+        ends = np.cumsum(np.count_nonzero(range_image[..., 0] > 0, axis=(1, 2)))
+        starts = np.concatenate([[0], ends[:-1]])
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            points[i].append(laser_points[start:end])
+            intensity[i].append(values[start:end, 1])
+            elongation[i].append(values[start:end, 2])
+    return sum(points, []), sum(intensity, []), sum(elongation, [])
+
+
+class PointCloudBuffer:
+    """ float32 point clouds assembled in buffers reused from one frame to the
+    next, one buffer per key, e.g. per engine
+    """
+
+    def __init__(self):
+        self.buffers = {}
+
+    def assemble(self, key, points, intensity, elongation, return_index=None):
+        """ [N, C] point cloud of the lists of an engine, see
+        range_images_to_point_cloud, every item is copied once into place
+            :param key: buffer to assemble into, it grows as needed
+            :param return_index: return index of every item of the lists,
+                None for no return index column
+            :return: [N, 5] float32 array of x, y, z, intensity, elongation
+                ([N, 6] with the return index), only valid until the next
+                call with the same key
+        """
+        num_points = sum(len(p) for p in points)
+        columns = 5 if return_index is None else 6
+        buffer = self.buffers.get(key)
+        if buffer is None or buffer.shape[0] < num_points or buffer.shape[1] != columns:
+            # some room for the next frames, the number of points varies
+            buffer = np.empty((num_points + num_points // 8, columns), np.float32)
+            self.buffers[key] = buffer
+        point_cloud = buffer[:num_points]
+        start = 0
+        for i in range(len(points)):
+            end = start + len(points[i])
+            point_cloud[start:end, :3] = points[i]
+            point_cloud[start:end, 3] = intensity[i]
+            point_cloud[start:end, 4] = elongation[i]
+            if return_index is not None:
+                point_cloud[start:end, 5] = return_index[i]
+            start = end
+        return point_cloud
+
+
+def count_points_in_box(points, box):
+    """ number of points inside a 3d box, see
+    box_utils.compute_num_points_in_box_3d
+        :param points: [N, 3] points
+        :param box: center_x, center_y, center_z, length, width, height, heading
+        :return: number of points
+    """
+    center_x, center_y, center_z, length, width, height, heading = box
+    offsets = points[:, :3] - np.array([center_x, center_y, center_z], np.float32)
+    # cheap bounds first, the box fits in a circle of its half diagonal
+    near = (np.abs(offsets[:, 2]) <= height * 0.5) & \
+        (offsets[:, 0] ** 2 + offsets[:, 1] ** 2 <= (length ** 2 + width ** 2) * 0.25 + 1e-3)
+    offsets = offsets[near]
+    cos_heading, sin_heading = np.cos(heading), np.sin(heading)
+    # rotate by -heading into the box frame
+    along = offsets[:, 0] * cos_heading + offsets[:, 1] * sin_heading
+    across = -offsets[:, 0] * sin_heading + offsets[:, 1] * cos_heading
+    inside = (np.abs(along) <= length * 0.5) & (np.abs(across) <= width * 0.5)
+    return int(np.count_nonzero(inside))
+
+
+def compare_point_clouds(expected, actual, atol=VALIDATE_ATOL):
+    """ raise ValueError if two point clouds differ by more than atol """
+    if expected.shape != actual.shape:
+        raise ValueError('point clouds of shapes {} and {}'.format(expected.shape, actual.shape))
+    diff = np.max(np.abs(expected - actual)) if expected.size > 0 else 0.0
+    if diff > atol:
+        raise ValueError('point clouds differ by up to {}'.format(diff))
+    return diff
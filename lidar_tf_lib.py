@@ -0,0 +1,82 @@
+import numpy as np
+import tensorflow as tf
+
+from waymo_open_dataset.utils import range_image_utils
+from waymo_open_dataset.utils import transform_utils
+from lidar_lib import LASER_TOP
+
+
+class GraphPointCloud:
+    """ point cloud of all the lasers of a frame computed by one tf.function
+    The pixel poses of the top laser, the conversion of every range image to
+    cartesian points and the masking of the invalid pixels are traced into a
+    single graph, with an input signature fixed to the range image shapes of
+    the lasers. One graph is traced per set of shapes, a Waymo segment uses a
+    single one. The returns of a laser are stacked and computed as a batch.
+    """
+
+    def __init__(self):
+        self.functions = {}
+
+    def __call__(self, geometries, range_images, range_image_top_pose, frame_pose,
+                 returns=(0,)):
+        """ see lidar_lib.range_images_to_point_cloud
+            :return: lists of points, intensity and elongation, all the
+                lasers of a return concatenated in a single item, one item
+                per return
+        """
+        images = tuple(np.stack([range_images[g.name][i] for i in returns])
+                       for g in geometries)
+        inclinations = tuple(g.inclination for g in geometries)
+        extrinsics = np.stack([g.extrinsic for g in geometries])
+        names = tuple(g.name for g in geometries)
+        key = (names, tuple(image.shape for image in images),
+               np.shape(range_image_top_pose))
+        if key not in self.functions:
+            self.functions[key] = self.trace(names, images, range_image_top_pose)
+        points, intensity, elongation = self.functions[key](
+            images, inclinations, extrinsics, range_image_top_pose, frame_pose)
+        return [p.numpy() for p in points], [i.numpy() for i in intensity], \
+            [e.numpy() for e in elongation]
+
+    def trace(self, names, images, range_image_top_pose):
+        signature = [
+            tuple(tf.TensorSpec(image.shape, tf.float32) for image in images),
+            tuple(tf.TensorSpec([image.shape[1]], tf.float32) for image in images),
+            tf.TensorSpec([len(images), 4, 4], tf.float64),
+            tf.TensorSpec(np.shape(range_image_top_pose), tf.float32),
+            tf.TensorSpec([4, 4], tf.float64)]
+
+        num_returns = images[0].shape[0]
+
+        @tf.function(input_signature=signature)
+        def point_cloud(images, inclinations, extrinsics, top_pose, frame_pose):
+            rotation = transform_utils.get_rotation_matrix(
+                top_pose[..., 0], top_pose[..., 1], top_pose[..., 2])
+            pixel_pose = transform_utils.get_transform(rotation, top_pose[..., 3:])
+            points = [[] for _ in range(num_returns)]
+            values = [[] for _ in range(num_returns)]
+            # unrolled at trace time, one branch per laser and return
+            for i, name in enumerate(names):
+                pixel_pose_local = None
+                frame_pose_local = None
+                if name == LASER_TOP:
+                    pixel_pose_local = tf.tile(tf.expand_dims(pixel_pose, axis=0),
+                                               [num_returns, 1, 1, 1, 1])
+                    frame_pose_local = tf.tile(tf.expand_dims(frame_pose, axis=0),
+                                               [num_returns, 1, 1])
+                cartesian = range_image_utils.extract_point_cloud_from_range_image(
+                    images[i][..., 0],
+                    tf.tile(tf.expand_dims(extrinsics[i], axis=0), [num_returns, 1, 1]),
+                    tf.tile(tf.expand_dims(inclinations[i], axis=0), [num_returns, 1]),
+                    pixel_pose=pixel_pose_local,
+                    frame_pose=frame_pose_local)
+                for r in range(num_returns):
+                    mask = tf.where(images[i][r, ..., 0] > 0)
+                    points[r].append(tf.gather_nd(cartesian[r], mask))
+                    values[r].append(tf.gather_nd(images[i][r], mask))
+            values = [tf.concat(v, axis=0) for v in values]
+            return tuple(tf.concat(p, axis=0) for p in points), \
+                tuple(v[:, 1] for v in values), tuple(v[:, 2] for v in values)
+
+        return point_cloud
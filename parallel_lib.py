@@ -0,0 +1,382 @@
+import collections
+import os
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
+
+# one unit of work for a conversion worker
+#   index: position of the segment in the data_records list
+#   num_records: number of records of the segment
+#   frame_num: number of records cvt has seen before this segment
+#   frame_name: first output index reserved for this segment
+#   reserved: number of output indices reserved for this segment
+SegmentJob = collections.namedtuple(
+    'SegmentJob', ['index', 'file_name', 'num_records', 'frame_num',
+                   'frame_name', 'reserved'])
+
+
+def count_keyframes(frame_num, num_records, keyframe):
+    """ number of records of a segment selected by the keyframe rule
+    (frame_num % keyframe == 0) when the segment starts at frame_num
+    """
+    return (frame_num + num_records - 1) // keyframe - (frame_num - 1) // keyframe
+
+
+def advance_frame_num(frame_num, num_records, keyframe, excluded=False):
+    """ value of cvt's frame counter after a segment of num_records records """
+    if not excluded:
+        return frame_num + num_records
+    # frames rejected by the location filter are not counted, so the counter
+    # stops on the first keyframe of an excluded segment
+    next_keyframe = -(-frame_num // keyframe) * keyframe
+    return min(frame_num + num_records, next_keyframe)
+
+
+def plan_segments(file_names, record_counts, keyframe, start_ind, excluded=None):
+    """ give every segment the frame counter it would start with in a
+    sequential run and a block of output indices large enough for all its
+    keyframes, so segments can be converted in any order without collisions
+        :param file_names: list of .tfrecord paths, in conversion order
+        :param record_counts: number of records of each segment
+        :param keyframe: keep every keyframe-th record
+        :param start_ind: first output index
+        :param excluded: optional list of flags, True if a segment is
+            rejected by the location filter
+        :return: list of SegmentJob
+    """
+    jobs = []
+    frame_num = 0
+    frame_name = start_ind
+    for index, (file_name, num_records) in enumerate(zip(file_names, record_counts)):
+        skip = excluded is not None and excluded[index]
+        reserved = 0 if skip else count_keyframes(frame_num, num_records, keyframe)
+        jobs.append(SegmentJob(index, file_name, num_records,
+                               frame_num, frame_name, reserved))
+        frame_num = advance_frame_num(frame_num, num_records, keyframe, skip)
+        frame_name += reserved
+    return jobs
+
+
+def shard_jobs(jobs, num_shards, shard_id):
+    """ contiguous slice of the planned segments converted by one shard, the
+    split only depends on the number of segments so every node computes the
+    same one
+    """
+    begin = len(jobs) * shard_id // num_shards
+    end = len(jobs) * (shard_id + 1) // num_shards
+    return jobs[begin:end]
+
+
+def estimate_cost(job):
+    """ relative cost of converting a segment
+    Records are read in full whatever the keyframe setting, while the
+    conversion cost of a keyframe grows with its size: a record with more
+    points and objects is larger on disk.
+    """
+    file_size = os.path.getsize(job.file_name)
+    if job.num_records == 0:
+        return 0.0
+    record_size = file_size / job.num_records
+    # reading a record is much cheaper than converting it
+    return record_size * (job.reserved + 0.1 * job.num_records)
+
+
+def schedule_jobs(jobs):
+    """ order the jobs longest first, so that no long segment is left running
+    alone at the end of a parallel conversion
+    """
+    return sorted(jobs, key=lambda job: (-estimate_cost(job), job.index))
+
+
+def available_cores():
+    """ number of cores this process may run on """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def thread_layout(cores_per_worker, workers=None):
+    """ split the available cores between conversion workers
+        :param cores_per_worker: threads given to each worker
+        :param workers: number of workers, None to fill the available cores
+        :return: (available cores, workers, threads per worker, inter-op threads)
+    """
+    cores = available_cores()
+    if workers is None:
+        workers = max(1, cores // cores_per_worker)
+    # TF runs few independent ops at once in the conversion, most of the work
+    # is inside single ops
+    inter_op = min(2, cores_per_worker)
+    return cores, workers, cores_per_worker, inter_op
+
+
+def prefetch(items, size):
+    """ iterate over items while a background thread computes up to size of
+    the next ones, an exception of the thread is raised here
+    """
+    buffer = queue.Queue(max(1, size))
+    done = object()
+
+    def produce():
+        try:
+            for item in items:
+                buffer.put((True, item))
+            buffer.put((True, done))
+        except BaseException as e:
+            buffer.put((False, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    while True:
+        ok, item = buffer.get()
+        if not ok:
+            raise item
+        if item is done:
+            break
+        yield item
+
+
+class SharedArrayRing:
+    """ fixed pool of shared memory slots handing numpy arrays from one
+    process to another without pickling them
+    The ring is passed to the processes at creation. A producer copies the
+    arrays of a frame into a free slot with put, blocking while all slots are
+    in use, and sends the returned handle to a consumer, which reads the
+    arrays in place with get and gives the slot back with release.
+    """
+    ALIGNMENT = 64
+
+    def __init__(self, ctx, num_slots, slot_size):
+        if shared_memory is None:
+            raise RuntimeError('shared memory needs python 3.8 or newer')
+        self.slot_size = slot_size
+        self.shm = shared_memory.SharedMemory(
+            create=True, size=num_slots * slot_size)
+        self.free_slots = ctx.Queue()
+        for slot in range(num_slots):
+            self.free_slots.put(slot)
+
+    def put(self, arrays):
+        """ copy a dict of arrays into a free slot
+                :return: handle of the slot
+        """
+        layout = []
+        offset = 0
+        for key, array in arrays.items():
+            array = np.asarray(array)
+            offset = -(-offset // self.ALIGNMENT) * self.ALIGNMENT
+            layout.append((key, array.dtype.str, array.shape, offset))
+            offset += array.nbytes
+        if offset > self.slot_size:
+            raise ValueError('{} bytes do not fit in a slot of {} bytes'.format(
+                offset, self.slot_size))
+        slot = self.free_slots.get()
+        for key, dtype, shape, offset in layout:
+            self.view(slot, dtype, shape, offset)[...] = arrays[key]
+        return slot, layout
+
+    def get(self, handle):
+        """ dict of arrays of a slot, they are views on the shared memory and
+        must not be used after release
+        """
+        slot, layout = handle
+        return {key: self.view(slot, dtype, shape, offset)
+                for key, dtype, shape, offset in layout}
+
+    def release(self, handle):
+        self.free_slots.put(handle[0])
+
+    def view(self, slot, dtype, shape, offset):
+        return np.ndarray(shape, dtype, self.shm.buf,
+                          slot * self.slot_size + offset)
+
+    def unlink(self):
+        """ free the shared memory, called once by the creating process """
+        self.shm.close()
+        self.shm.unlink()
+
+
+# one step of run_pipeline
+#   fn: called as fn(state, item, emit) for every item, emit(item) sends an
+#       item to the next stage
+#   workers: number of processes running the stage
+#   setup: builds the state of a process
+Stage = collections.namedtuple('Stage', ['fn', 'workers', 'setup'])
+
+
+def stage_worker(stage, in_queue, out_queue, error_queue):
+    try:
+        state = stage.setup()
+        while True:
+            item = in_queue.get()
+            if item is None:
+                break
+            stage.fn(state, item, out_queue.put)
+    except BaseException:
+        error_queue.put(('error', traceback.format_exc()))
+        raise
+
+
+def run_pipeline(ctx, stages, items, queue_size):
+    """ run items through a chain of stages, every stage in its own processes
+        :param ctx: multiprocessing context
+        :param stages: list of Stage
+        :param items: input of the first stage
+        :param queue_size: maximum number of items waiting between two stages
+        :return: iterator over the items emitted by the last stage
+    """
+    queues = [ctx.Queue()] + [ctx.Queue(queue_size) for _ in stages[1:]] + [ctx.Queue()]
+    results = queues[-1]
+    processes = []
+    for i, stage in enumerate(stages):
+        processes.append([ctx.Process(target=stage_worker,
+                                      args=(stage, queues[i], queues[i + 1], results))
+                          for _ in range(stage.workers)])
+    for stage_processes in processes:
+        for process in stage_processes:
+            process.start()
+    for item in items:
+        queues[0].put(item)
+
+    def shutdown():
+        # a stage is told to stop once all the processes feeding it are done
+        for i, stage_processes in enumerate(processes):
+            for _ in stage_processes:
+                queues[i].put(None)
+            for process in stage_processes:
+                process.join()
+        results.put(None)
+
+    thread = threading.Thread(target=shutdown, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is None:
+                break
+            if item[0] == 'error':
+                raise RuntimeError('pipeline worker failed:\n' + item[1])
+            yield item
+        thread.join()
+    finally:
+        for stage_processes in processes:
+            for process in stage_processes:
+                if process.is_alive():
+                    process.terminate()
+
+
+class CpuSampler:
+    """ busy and I/O wait fractions of the machine's CPUs between two calls of
+    sample, read from /proc/stat, None where it is not available
+    """
+
+    def __init__(self):
+        self.last = self.read()
+
+    def read(self):
+        try:
+            with open('/proc/stat', 'r') as f:
+                # user nice system idle iowait irq softirq steal
+                return [int(v) for v in f.readline().split()[1:9]]
+        except (IOError, ValueError):
+            return None
+
+    def sample(self):
+        """ (busy, iowait) fractions since the last sample """
+        now = self.read()
+        last, self.last = self.last, now
+        if now is None or last is None:
+            return None, None
+        delta = [a - b for a, b in zip(now, last)]
+        total = sum(delta)
+        if total <= 0:
+            return None, None
+        return 1.0 - (delta[3] + delta[4]) / total, delta[4] / total
+
+
+class AutoScaler:
+    """ hill climbing on the number of segments converted at once
+    Throughput is measured over a window of finished segments. The number of
+    workers moves one step at a time in the current direction while the
+    throughput improves by more than tolerance, turns around when it drops
+    and stays put on a plateau, probing a neighbour every probe_every windows.
+    Growth stops when the CPUs are saturated, when the disk is the bottleneck
+    (high I/O wait) or when the time to write a frame climbs.
+    """
+
+    def __init__(self, max_workers, workers=None, tolerance=0.05, probe_every=4):
+        self.max_workers = max_workers
+        self.workers = workers or max(1, max_workers // 2)
+        self.tolerance = tolerance
+        self.probe_every = probe_every
+        self.direction = 1
+        self.best = None
+        self.best_latency = None
+        self.throughput = 0.0
+        self.holding = 0
+        self.cpu = CpuSampler()
+        self.start_window()
+
+    def start_window(self):
+        self.window_start = time.time()
+        self.window_frames = 0
+        self.window_segments = 0
+        self.window_write_seconds = 0.0
+
+    def update(self, frames, write_seconds):
+        """ account a finished segment
+            :param frames: number of keyframes it converted
+            :param write_seconds: time it spent writing files
+            :return: number of workers to run
+        """
+        self.window_frames += frames
+        self.window_write_seconds += write_seconds
+        self.window_segments += 1
+        # every running worker finishes about one segment per window
+        if self.window_segments < max(2, self.workers):
+            return self.workers
+        elapsed = max(time.time() - self.window_start, 1e-6)
+        self.throughput = self.window_frames / elapsed
+        latency = self.window_write_seconds / max(self.window_frames, 1)
+        busy, iowait = self.cpu.sample()
+        self.decide(self.throughput, latency, busy, iowait)
+        self.start_window()
+        return self.workers
+
+    def decide(self, throughput, latency, busy, iowait):
+        if self.best is None or throughput > self.best * (1 + self.tolerance):
+            self.best = throughput
+            self.best_latency = latency
+            self.holding = 0
+            saturated = (busy is not None and busy > 0.95) or \
+                (iowait is not None and iowait > 0.25)
+            if self.direction > 0 and saturated:
+                self.direction = -1
+            else:
+                self.step()
+        elif throughput < self.best * (1 - self.tolerance):
+            # worse than the best level, go back
+            self.direction = -self.direction
+            self.step()
+        else:
+            self.best = max(self.best, throughput)
+            self.holding += 1
+            slower_writes = self.best_latency and latency > 1.5 * self.best_latency
+            if slower_writes and self.workers > 1:
+                self.direction = -1
+                self.step()
+            elif self.holding >= self.probe_every:
+                self.holding = 0
+                self.step()
+
+    def step(self):
+        workers = min(self.max_workers, max(1, self.workers + self.direction))
+        if workers == self.workers:
+            self.direction = -self.direction
+        self.workers = workers
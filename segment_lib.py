@@ -0,0 +1,234 @@
+import json
+import os
+import tempfile
+
+from frame_lib import read_frame_key, read_location, read_stats
+from tfrecord_lib import detect_compression, index_records, iter_records
+
+# bytes read from the start of a record to find its context and timestamp
+FRAME_KEY_BYTES = 1 << 16
+
+
+def read_json(path, default=None):
+    """ content of a json file, default if it does not exist """
+    if not os.path.exists(path):
+        return default
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def write_json(path, content):
+    """ replace a json file atomically, a crash never leaves it half written
+    and processes writing it at the same time each use their own temporary
+    file, the last one wins
+    """
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.tmp',
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(content, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class Manifest:
+    """ record of the segments converted into a KITTI folder, used to resume
+    an interrupted conversion
+    Segments are keyed by file name, a completed segment maps to a dict of
+        frame_num, frame_num_end: frame counter of cvt before and after it
+        block: first output index planned for it by plan_segments, the same
+            in sequential and parallel runs
+        start, end: index range of its frames in the output
+        num_saved: number of frames it saved
+        in_block: True while its frames start at block, False once earlier
+            segments saved fewer frames than planned or they were renumbered
+        checksum: md5 of its output files
+        seconds: conversion time, None if unknown
+    Entries are only valid for the settings the manifest was created with.
+    """
+
+    def __init__(self, path, settings, restart=False):
+        self.path = path
+        content = None if restart else read_json(path)
+        if content is not None and content['settings'] != settings:
+            print('Conversion settings changed, ignoring ' + path)
+            content = None
+        if content is None:
+            content = {'settings': settings, 'segments': {}}
+        self.content = content
+        self.segments = content['segments']
+
+    def find(self, name, frame_num, block):
+        """ entry of a segment completed with the same frame counter and
+        output block, None otherwise
+        """
+        entry = self.segments.get(name)
+        if entry is not None and entry['frame_num'] == frame_num and entry['block'] == block:
+            return entry
+        return None
+
+    def add(self, name, entry):
+        self.segments[name] = entry
+        self.save()
+
+    def remove(self, name):
+        return self.segments.pop(name, None)
+
+    def ranges(self, names):
+        """ output index ranges of the given completed segments """
+        return [(self.segments[name]['start'], self.segments[name]['end'])
+                for name in names if name in self.segments]
+
+    def save(self):
+        write_json(self.path, self.content)
+
+
+def read_record_start(f, offset, length, parse):
+    """ read the start of a record, long enough for its context and timestamp
+        :param f: open uncompressed .tfrecord file
+        :param offset, length: position of the record, see index_records
+        :param parse: called with the start of the record, raises ValueError
+            if it is too short
+        :return: (start of the record, result of parse)
+    """
+    f.seek(offset)
+    start = f.read(min(length, FRAME_KEY_BYTES))
+    try:
+        return start, parse(start)
+    except ValueError:
+        # unusually large context, read the whole record
+        f.seek(offset)
+        start = f.read(length)
+        return start, parse(start)
+
+
+def segment_index(path, index_dir):
+    """ index of the records of a segment, built on first use and saved in
+    index_dir, it is rebuilt when the size or the modification time of the
+    file changes
+        :return: dict of
+            context_name: context.name of the frames
+            location: context.stats.location of the frames
+            records: list of [offset, length, timestamp_micros] of every
+                record, see tfrecord_lib.index_records
+    """
+    stat = os.stat(path)
+    index_path = index_dir + '/' + os.path.basename(path) + '.json'
+    index = read_json(index_path)
+    if index is not None and index['size'] == stat.st_size and \
+            index['mtime'] == stat.st_mtime and 'location' in index:
+        return index
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime,
+             'context_name': None, 'location': None, 'records': []}
+    with open(path, 'rb') as f:
+        for offset, length in index_records(path):
+            start, (name, timestamp) = read_record_start(f, offset, length, read_frame_key)
+            if index['location'] is None:
+                index['location'] = read_location(start)
+            index['context_name'] = name
+            index['records'].append([offset, length, timestamp])
+    os.makedirs(index_dir, exist_ok=True)
+    write_json(index_path, index)
+    return index
+
+
+def read_frame_list(path):
+    """ frames listed in a text file, one per line as either
+        <segment file name> <frame index in the segment>
+        <context name> <timestamp_micros>
+    separated by spaces or a comma, empty lines and lines starting with #
+    are ignored
+        :return: list of ('segment', file name, index) or
+            ('context', context name, timestamp)
+    """
+    frames = []
+    with open(path, 'r') as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if len(line) == 0 or line.startswith('#'):
+                continue
+            fields = line.replace(',', ' ').split()
+            if len(fields) != 2 or not fields[1].isdigit():
+                raise ValueError('{}:{}: expected "<segment or context> <index or '
+                                 'timestamp>"'.format(path, line_num))
+            kind = 'segment' if fields[0].endswith('.tfrecord') else 'context'
+            frames.append((kind, fields[0], int(fields[1])))
+    return frames
+
+
+class MetadataCache:
+    """ metadata of segments read from their frame contexts, kept in a json
+    file so a segment is only scanned again when it changes
+    Segments are keyed by path, an entry holds
+        size, mtime: of the file when the entry was built
+        num_records: number of records
+        context_name, location, time_of_day, weather: from the first frame
+        laser_objects: number of lidar labelled objects of every frame
+        laser_object_counts: {label type: number of objects} summed over the
+            frames
+    New entries are only written by save, which keeps the entries saved
+    meanwhile by other processes, e.g. other shards.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = read_json(path, {})
+        # keys of the entries built since the last save
+        self.changed = set()
+
+    def get(self, file_name, compression=None):
+        """ metadata of a segment, built if it is not cached or outdated
+            :param compression: compression type of the file, None to detect it
+        """
+        stat = os.stat(file_name)
+        key = os.path.abspath(file_name)
+        entry = self.segments.get(key)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            return entry
+        entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'num_records': 0,
+                 'context_name': '', 'location': '', 'time_of_day': '', 'weather': '',
+                 'laser_objects': [], 'laser_object_counts': {}}
+        for start in self.record_starts(file_name, compression):
+            stats = read_stats(start)
+            if entry['num_records'] == 0:
+                entry['context_name'] = read_frame_key(start)[0]
+                for field in ['location', 'time_of_day', 'weather']:
+                    entry[field] = stats[field]
+            entry['num_records'] += 1
+            entry['laser_objects'].append(sum(stats['laser_object_counts'].values()))
+            for object_type, count in stats['laser_object_counts'].items():
+                counts = entry['laser_object_counts']
+                counts[str(object_type)] = counts.get(str(object_type), 0) + count
+        self.segments[key] = entry
+        self.changed.add(key)
+        return entry
+
+    def record_starts(self, file_name, compression):
+        """ start of every record, a compressed file is read in full """
+        if compression is None:
+            compression = detect_compression(file_name)
+        if compression != '':
+            yield from iter_records(file_name, compression=compression)
+            return
+        with open(file_name, 'rb') as f:
+            for offset, length in index_records(file_name):
+                start, _ = read_record_start(f, offset, length, read_stats)
+                yield start
+
+    def save(self):
+        """ write the entries built since the last save, if any """
+        if len(self.changed) == 0:
+            return
+        segments = read_json(self.path, {})
+        segments.update((key, self.segments[key]) for key in self.changed)
+        self.segments = segments
+        self.changed = set()
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        write_json(self.path, segments)
@@ -0,0 +1,231 @@
+import gzip
+import io
+import mmap
+import os
+import struct
+import zlib
+
+try:
+    import crc32c as _crc32c
+except ImportError:  # verified with the pure python table below
+    _crc32c = None
+
+# every record is framed as: uint64 length, uint32 masked crc of length,
+# data, uint32 masked crc of data
+HEADER_LENGTH = 12
+FOOTER_LENGTH = 4
+CRC_MASK_DELTA = 0xa282ead8
+# compression types of tf.data.TFRecordDataset, the whole file is a single
+# gzip or zlib stream
+COMPRESSION_TYPES = ['', 'GZIP', 'ZLIB']
+CHUNK_SIZE = 1 << 16
+
+
+def make_crc_table():
+    table = []
+    for n in range(256):
+        crc = n
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0x82f63b78 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC_TABLE = make_crc_table()
+
+
+def crc32c(data):
+    """ CRC-32C (Castagnoli) of data, with the crc32c package when it is
+    installed, the pure python fallback is slow
+    """
+    if _crc32c is not None:
+        return _crc32c.crc32c(data)
+    crc = 0xffffffff
+    table = CRC_TABLE
+    for byte in bytes(data):
+        crc = table[(crc ^ byte) & 0xff] ^ (crc >> 8)
+    return crc ^ 0xffffffff
+
+
+def masked_crc(data):
+    """ checksum of a record part as stored in a .tfrecord file """
+    crc = crc32c(data)
+    return (((crc >> 15) | (crc << 17)) + CRC_MASK_DELTA) & 0xffffffff
+
+
+def check_crc(data, stored, path):
+    if masked_crc(data) != struct.unpack('<I', stored)[0]:
+        raise IOError('corrupted record in ' + path)
+
+
+class ZlibReader(io.RawIOBase):
+    """ readable file decompressing a zlib stream on the fly """
+
+    def __init__(self, f):
+        self.f = f
+        self.decompressor = zlib.decompressobj()
+        self.pending = b''
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self.pos == len(self.pending):
+            if self.decompressor.eof:
+                return 0
+            chunk = self.f.read(CHUNK_SIZE)
+            if len(chunk) == 0:
+                raise IOError('truncated zlib stream')
+            self.pending = self.decompressor.decompress(chunk)
+            self.pos = 0
+        n = min(len(b), len(self.pending) - self.pos)
+        b[:n] = self.pending[self.pos:self.pos + n]
+        self.pos += n
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+def detect_compression(path):
+    """ compression type of a .tfrecord file from its first bytes, an
+    uncompressed file starts with a record length and its checksum
+    """
+    with open(path, 'rb') as f:
+        start = f.read(HEADER_LENGTH)
+    if len(start) == HEADER_LENGTH and masked_crc(start[:8]) == struct.unpack('<I', start[8:])[0]:
+        return ''
+    if start[:2] == b'\x1f\x8b':
+        return 'GZIP'
+    if len(start) >= 2 and start[0] & 0x0f == 8 and (start[0] << 8 | start[1]) % 31 == 0:
+        return 'ZLIB'
+    return ''
+
+
+def open_records(path, compression=None, buffer_size=-1):
+    """ open a .tfrecord file for reading
+        :param compression: one of COMPRESSION_TYPES, None to detect it
+        :return: (file, compression type), a compressed file is decompressed
+            while it is read and can only seek forward
+    """
+    if compression is None:
+        compression = detect_compression(path)
+    if compression not in COMPRESSION_TYPES:
+        raise ValueError('unknown compression type ' + compression)
+    f = open(path, 'rb', buffer_size)
+    if compression == 'GZIP':
+        f = gzip.GzipFile(fileobj=f, mode='rb')
+    elif compression == 'ZLIB':
+        f = io.BufferedReader(ZlibReader(f), CHUNK_SIZE)
+    return f, compression
+
+
+def read_header(f, path):
+    """ read the length of the next record, None at the end of the file """
+    header = f.read(HEADER_LENGTH)
+    if len(header) == 0:
+        return None
+    if len(header) < HEADER_LENGTH:
+        raise IOError('truncated record header in ' + path)
+    length, = struct.unpack('<Q', header[:8])
+    return length
+
+
+def index_records(path):
+    """ (offset, length) of the data of every record of a .tfrecord file,
+    only the length headers are read
+    """
+    if detect_compression(path) != '':
+        raise IOError('random access needs an uncompressed file: ' + path)
+    records = []
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        while True:
+            length = read_header(f, path)
+            if length is None:
+                break
+            offset = f.tell()
+            if offset + length + FOOTER_LENGTH > file_size:
+                raise IOError('truncated record in ' + path)
+            records.append((offset, length))
+            f.seek(length + FOOTER_LENGTH, os.SEEK_CUR)
+    return records
+
+
+def read_record(f, offset, length, path, verify=False):
+    """ data of the record at offset of an open .tfrecord file, see
+    index_records
+    """
+    f.seek(offset)
+    data = f.read(length)
+    footer = f.read(FOOTER_LENGTH)
+    if len(data) < length or len(footer) < FOOTER_LENGTH:
+        raise IOError('truncated record in ' + path)
+    if verify:
+        check_crc(data, footer, path)
+    return data
+
+
+def iter_records(path, buffer_size=-1, verify=False, use_mmap=False, compression=None):
+    """ iterate over the data of the records of a .tfrecord file
+        :param buffer_size: read buffer in bytes, -1 for the default
+        :param verify: check the CRC of every record
+        :param use_mmap: map the file in memory instead of reading it, the
+            records are then memoryviews of the mapping, ignored for a
+            compressed file
+        :param compression: one of COMPRESSION_TYPES, None to detect it
+    """
+    if compression is None:
+        compression = detect_compression(path)
+    if use_mmap and compression == '':
+        yield from iter_mapped_records(path, verify)
+        return
+    f, _ = open_records(path, compression, buffer_size)
+    with f:
+        while True:
+            header = f.read(HEADER_LENGTH)
+            if len(header) == 0:
+                break
+            if len(header) < HEADER_LENGTH:
+                raise IOError('truncated record header in ' + path)
+            length, = struct.unpack('<Q', header[:8])
+            data = f.read(length)
+            footer = f.read(FOOTER_LENGTH)
+            if len(data) < length or len(footer) < FOOTER_LENGTH:
+                raise IOError('truncated record in ' + path)
+            if verify:
+                check_crc(header[:8], header[8:], path)
+                check_crc(data, footer, path)
+            yield data
+
+
+def iter_mapped_records(path, verify=False):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    view = memoryview(mapped)
+    try:
+        pos = 0
+        while pos < len(view):
+            if pos + HEADER_LENGTH > len(view):
+                raise IOError('truncated record header in ' + path)
+            length, = struct.unpack_from('<Q', view, pos)
+            start = pos + HEADER_LENGTH
+            end = start + length
+            if end + FOOTER_LENGTH > len(view):
+                raise IOError('truncated record in ' + path)
+            if verify:
+                check_crc(view[pos:pos + 8], view[pos + 8:start], path)
+                check_crc(view[start:end], view[end:end + FOOTER_LENGTH], path)
+            yield view[start:end]
+            pos = end + FOOTER_LENGTH
+    finally:
+        try:
+            view.release()
+            mapped.close()
+        except BufferError:
+            # records still in use, the mapping is closed with its last view
+            pass